@@ -1,12 +1,18 @@
 import os
+import time
 import logging
 import json
+import threading
+from typing import Iterator, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from semantic_kernel.functions import kernel_function
 from dotenv import load_dotenv
 from azure.ai.projects import AIProjectClient
 from azure.ai.projects.models import ConnectionType
 from azure.identity import DefaultAzureCredential
 from azure.ai.projects.models import AzureAISearchTool
+from azure.ai.projects.models import AgentStreamEvent, MessageDeltaChunk, ThreadRun
 from semantic_kernel.agents import ChatCompletionAgent
 from semantic_kernel.connectors.ai.open_ai import AzureChatCompletion
 from semantic_kernel.contents.chat_message_content import ChatMessageContent
@@ -19,6 +25,10 @@ from rich.console import Console
 from rich.panel import Panel
 from rich.markdown import Markdown
 from azure.identity import ClientSecretCredential
+from agent_runtime import (AGENT_THREAD_IDLE_SECONDS, AGENT_THREAD_MAX_SESSIONS, RunTimeout, SearchAgent,
+                           WarmThreadPool, run_driver, run_reply)
+from answer_cache import answer_cache, answer_once, is_cacheable, join_question, question_flight
+from metrics import stage
 
  
 load_dotenv()
@@ -42,20 +52,10 @@ class IAMAssistant:
             conn_str=os.environ["AIPROJECT_CONNECTION_STRING"],
         )
 
-        # Find Cognitive Search connection
-        conn_list = self.project_client.connections.list()
-        conn_id = next(
-            (conn.id for conn in conn_list if conn.connection_type == "CognitiveSearch"),
-            None
-        )
-        if not conn_id:
-            raise RuntimeError("No Cognitive Search connection found for IAM documents.")
-
-        # Configure Azure AI Search Tooll
-        self.ai_search = AzureAISearchTool(index_connection_id=conn_id, index_name="iam-docs-rag")
-
-        # Create the agent once
-        self.iam_agent = self.project_client.agents.create_agent(
+        # Reuse the agent from a previous start when its configuration is unchanged
+        self.agent = SearchAgent(
+            self.project_client,
+            key="iam-assistant-chat",
             model="gpt-4.1-nano",  # ensure this model exists in your Azure project
             name="IAM Assistant",
             instructions=
@@ -68,32 +68,186 @@ You should ONLY use the provided IAM documentation for answering user queries fr
 5. **Do not guess or make inferences**: Only answer based on what’s available in the documentation.
 Always ensure the responses are professional and accurate."""
             ,
-            tools=self.ai_search.definitions,
-            tool_resources=self.ai_search.resources,
+            index_name="iam-docs-rag",
         )
 
-    def create_thread(self) -> str:
-        """Create and return a new thread id."""
-        thread = self.project_client.agents.create_thread()
-        return thread.id
+        # Threads are pre-created in the background so a new chat does not wait on the service
+        self.threads = WarmThreadPool(self.project_client)
+        # Cached answers are still written to the thread, in the background, so it stays complete
+        self._background = ThreadPoolExecutor(max_workers=2, thread_name_prefix="cached-answers")
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        # Threads with no messages yet (id -> created): only their first question is free of conversation
+        # context. Bounded like agent sessions; a thread dropped here just misses the cache.
+        self._fresh_threads: "OrderedDict[str, float]" = OrderedDict()
+        self._fresh_lock = threading.Lock()
 
-    def chat_on_thread(self, thread_id: str, user_query: str) -> str:
-        """Send a user message to a given thread and return the assistant response text."""
+    def create_thread(self) -> str:
+        """Return a new thread id, taken from the warm pool when one is ready."""
+        thread_id = self.threads.take()
+        now = time.time()
+        with self._fresh_lock:
+            self._fresh_threads[thread_id] = now
+            while self._fresh_threads and (len(self._fresh_threads) > AGENT_THREAD_MAX_SESSIONS or
+                                           now - next(iter(self._fresh_threads.values())) > AGENT_THREAD_IDLE_SECONDS):
+                self._fresh_threads.popitem(last=False)
+        return thread_id
+
+    def _post_exchange(self, thread_id: str, user_query: str, answer: str):
+        self.project_client.agents.create_message(thread_id=thread_id, role="user", content=user_query)
+        self.project_client.agents.create_message(thread_id=thread_id, role="assistant", content=answer)
+
+    def _record_in_background(self, thread_id: str, user_query: str, answer: str):
+        """Writes an answer that did not come from a run on this thread (cached or shared) to the thread."""
+        future = self._background.submit(self._post_exchange, thread_id, user_query, answer)
+        with self._pending_lock:
+            self._pending[thread_id] = future
+        future.add_done_callback(lambda f: self._forget_pending(thread_id, f))
+
+    def _forget_pending(self, thread_id: str, future):
+        # Written already, so the next question on the thread has nothing to wait for
+        with self._pending_lock:
+            if self._pending.get(thread_id) is future:
+                del self._pending[thread_id]
+        if future.exception() is not None:
+            logging.warning("Could not record cached answer on thread %s: %s", thread_id, future.exception())
+
+    def _cached_answer(self, thread_id: str, user_query: str):
+        """
+        Answer from the cache (recorded on the thread in the background) or None plus a key to store under.
+        - Only a thread's first question is cached or shared; later ones may lean on earlier turns
+          ("how do I reset it"), so their answers are specific to this conversation
+        """
+        self._wait_for_thread(thread_id)
+        with self._fresh_lock:
+            if self._fresh_threads.pop(thread_id, None) is None:
+                return None, None
+        answer, key = answer_cache.lookup(user_query)
+        if answer is not None:
+            self._record_in_background(thread_id, user_query, answer)
+        return answer, key
+
+    def _wait_for_thread(self, thread_id: str):
+        # Keep message order: a cached exchange must land before the next question on the thread
+        with self._pending_lock:
+            pending = self._pending.get(thread_id)
+        if pending is not None:
+            pending.exception()  # waits for the write; failures are logged by `_forget_pending`
+
+    def chat_on_thread(self, thread_id: str, user_query: str, cancel: Optional[threading.Event] = None) -> str:
+        """
+        Send a user message to a given thread and return the assistant response text.
+        - Setting `cancel` (e.g. on client disconnect) cancels the run and raises RunCancelled
+        """
+        answer, cache_key = self._cached_answer(thread_id, user_query)
+        if answer is not None:
+            return answer
+        # Identical questions already running for other users share that run's answer
+        reply, shared = answer_once(cache_key, lambda: self._run_on_thread(thread_id, user_query, cache_key, cancel),
+                                    cancel)
+        if shared:
+            self._record_in_background(thread_id, user_query, reply)
+        return reply
+
+    def _run_on_thread(self, thread_id: str, user_query: str, cache_key, cancel: Optional[threading.Event]) -> str:
+        started = time.perf_counter()
         self.project_client.agents.create_message(
             thread_id=thread_id,
             role="user",
             content=user_query,
         )
-        run = self.project_client.agents.create_and_process_run(
-            thread_id=thread_id,
-            assistant_id=self.iam_agent.id
-        )
-        if run.status == "failed":
+        try:
+            run = self.agent.call(lambda agent_id: run_driver.run(self.project_client, thread_id, agent_id, cancel))
+        except RunTimeout as e:
+            return f"Run failed: {e}"
+        if run.status != "completed":
             return f"Run failed: {run.last_error}"
 
-        messages = self.project_client.agents.list_messages(thread_id=thread_id)
-        last_message = messages.get_last_text_message_by_role("assistant")
-        return last_message.text.value if last_message and last_message.text else "No response received."
+        reply = run_reply(self.project_client, thread_id, run.id) or "No response received."
+        answer_cache.store(cache_key, reply, time.perf_counter() - started)
+        return reply
+
+    def stream_on_thread(self, thread_id: str, user_query: str,
+                         cancel: Optional[threading.Event] = None) -> Iterator[str]:
+        """
+        Send a user message to a given thread and yield assistant text deltas as they arrive.
+        - Closing the generator early (client disconnect) or passing the run deadline cancels the run;
+          a timer enforces the deadline even while the stream delivers no events
+        - Setting `cancel` stops a wait for an identical question's shared answer, and once set before
+          the message is posted, nothing is written to the thread
+        """
+        answer, cache_key = self._cached_answer(thread_id, user_query)
+        if answer is not None:
+            yield answer
+            return
+        answer, flight = join_question(cache_key, cancel)
+        if answer is not None:
+            self._record_in_background(thread_id, user_query, answer)
+            yield answer
+            return
+        reply = status = None
+        active = {"run_id": None}  # shared with the deadline timer
+        expired = threading.Event()
+
+        def on_deadline():
+            # A stalled stream yields no events, so the loop below cannot notice the deadline on its own
+            run_id = active["run_id"]
+            if run_id is not None:
+                expired.set()
+                run_driver.cancel(self.project_client, thread_id, run_id)
+
+        watchdog = threading.Timer(run_driver.deadline, on_deadline)
+        watchdog.daemon = True
+        try:
+            started = time.perf_counter()
+            parts = []
+            if cancel is not None and cancel.is_set():
+                return  # the client left while this question waited; no message, no run
+            self.project_client.agents.create_message(
+                thread_id=thread_id,
+                role="user",
+                content=user_query,
+            )
+            watchdog.start()
+            with stage("agent_run"), self.agent.call(lambda agent_id: self.project_client.agents.create_stream(
+                thread_id=thread_id,
+                assistant_id=agent_id
+            )) as stream:
+                for event_type, event_data, _ in stream:
+                    if expired.is_set() or time.perf_counter() - started > run_driver.deadline:
+                        yield f"Run failed: no answer within {run_driver.deadline:.0f}s"
+                        return
+                    if isinstance(event_data, ThreadRun):
+                        active["run_id"] = event_data.id
+                        status = getattr(event_data.status, "value", event_data.status)
+                        if status in ("completed", "failed", "cancelled", "expired", "incomplete"):
+                            active["run_id"] = None  # finished; nothing left to cancel
+                    if isinstance(event_data, MessageDeltaChunk):
+                        if event_data.text:
+                            parts.append(event_data.text)
+                            yield event_data.text
+                    elif isinstance(event_data, ThreadRun) and status in ("failed", "cancelled", "expired", "incomplete"):
+                        yield f"Run {status}: {event_data.last_error}" if event_data.last_error else f"Run {status}."
+                        return
+                    elif event_type == AgentStreamEvent.ERROR:
+                        raise RuntimeError(f"Agent stream error: {event_data}")
+            if expired.is_set():
+                # Cancelled by the timer and the stream just ended: the partial text is not an answer
+                yield f"Run failed: no answer within {run_driver.deadline:.0f}s"
+                return
+            if status != "completed":
+                # The stream ended without the run completing: partial text is neither cached nor shared
+                yield f"Run failed: the stream ended before the run completed (status {status})"
+                return
+            reply = "".join(parts)
+            answer_cache.store(cache_key, reply, time.perf_counter() - started)
+        finally:
+            watchdog.cancel()
+            if active["run_id"] is not None and not expired.is_set():
+                run_driver.cancel(self.project_client, thread_id, active["run_id"])
+            # Waiters get the answer only if the whole stream completed
+            if flight is not None:
+                question_flight.finish(cache_key[0], flight, reply if is_cacheable(reply) else None)
 
 # You call this when a new user session starts (Streamlit’s first request).
 
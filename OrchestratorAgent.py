@@ -1,5 +1,8 @@
 import os
 import json
+import time
+import logging
+from typing import Optional
 from semantic_kernel.kernel import Kernel
 from semantic_kernel.connectors.ai.open_ai import AzureChatCompletion
 from semantic_kernel.agents import ChatCompletionAgent
@@ -9,9 +12,23 @@ from semantic_kernel.contents.utils.author_role import AuthorRole
 from azure.identity import ClientSecretCredential
 from azure.ai.projects import AIProjectClient
 from semantic_kernel.contents.chat_history import ChatHistory
+from semantic_kernel.filters.filter_types import FilterTypes
 
 from iamassistant_orch import IAMAssistant
 from provisioning_orch import ProvisioningAgent
+from session_store import SessionStore, session_backend
+from history_compaction import CompactionStats, compact_history, count_tokens
+from intent_router import IntentRouter
+from agent_runtime import current_session
+from metrics import kernel_function, record_stage, request_stages
+
+
+def _drop_turn(history: ChatHistory, user_turn: ChatMessageContent):
+    for i in range(len(history.messages) - 1, -1, -1):
+        if history.messages[i] is user_turn:
+            del history.messages[i:]
+            return
+
 
 class OrchestratorAgentWrapper:
     def __init__(self):
@@ -36,16 +53,21 @@ class OrchestratorAgentWrapper:
                 api_key=CHAT_MODEL_API_KEY
             )
         )
+        self.iam_assistant = IAMAssistant(project_client=AIProjectClient.from_connection_string(
+            credential=credential,
+            conn_str=AIPROJECT_CONN_STR))
         self.kernel.add_plugin(
-            IAMAssistant(project_client=AIProjectClient.from_connection_string(
-                credential=credential,
-                conn_str=AIPROJECT_CONN_STR)),
+            self.iam_assistant,
             plugin_name="IAMAssistant"
         )
+        self.provisioning = ProvisioningAgent()
         self.kernel.add_plugin(
-            ProvisioningAgent(),
+            self.provisioning,
             plugin_name="ProvisioningAgent"
         )
+
+        # Time each plugin call the model makes and attribute its Graph calls to it
+        self.kernel.add_filter(FilterTypes.FUNCTION_INVOCATION, self._time_function)
         settings = self.kernel.get_prompt_execution_settings_from_service_id(service_id)
         settings.function_choice_behavior = FunctionChoiceBehavior.Auto()
 
@@ -95,6 +117,7 @@ The user will either ask an IAM related query, or ask you to perform an IAM prov
   - Only call the ProvisioningAgent when you got the Confirmation and UPN value from user.
 -If user asks to list all users or user's intent is to list all users:
   - call the ProvisioningAgent to get the list of users.
+  - If the user asks for a number of users, pass it as max_results; if they narrow the list (e.g. by department or a name), pass a filter_expression or search_text.
   -Return the entire plugin response and print the output as it is to the user.
   - give the users list even if the output is in json or not.
 -If user asks to Create a group or user's intent is to create group:
@@ -136,6 +159,17 @@ The user will either ask an IAM related query, or ask you to perform an IAM prov
   - call Provisioning agent to retrieve the list of groups with group display name and ID
   - Return the entire plugin response and print the output as it is to the user.
   - only call the ProvisioningAgent when you have the number of groups they want to get listed. 
+-If user asks to delete several users at once or user's intent is to bulk delete users:
+  - Collect every user id/UPN to delete.
+  - List all of the affected user ids back to the user and ask for Confirmation before deleting.
+  - Only call the ProvisioningAgent bulk_delete_users function after the user confirms that exact list.
+-If user asks to remove several users from one or more groups at once or user's intent is to bulk remove users from groups:
+  - Collect the user ids and the group ids.
+  - List all of the affected user ids and group ids back to the user and ask for Confirmation before removing.
+  - Only call the ProvisioningAgent bulk_remove_users_from_groups function after the user confirms that exact list.
+-If user asks to find/search users or groups by name, UPN prefix or department, or does not know a user's UPN/ID or a group's ID:
+  - call the ProvisioningAgent find_users, find_users_in_department or find_groups function with what the user gave.
+  - Return the matches and use the ID from the match the user picks for the follow-up action.
 # Response Rules:
 - Ask questions from users clearly.
 - Use plugins only if data is sufficient; otherwise ask for missing info.
@@ -150,23 +184,79 @@ The user will either ask an IAM related query, or ask you to perform an IAM prov
 """,
             execution_settings=settings
         )
+        self.sessions = SessionStore(backend=session_backend())
+        self.prompt_stats = CompactionStats()
+        self.router = IntentRouter()
+        self._instruction_tokens = count_tokens(self.orchestrator.instructions)
 
-    async def chat(self, thread_id: str, user_message: str, chat_history: list) -> dict:
-        # Rebuild chat history in semantic kernel format
-        sk_chat_history = ChatHistory()
-        for msg in chat_history:
-            role = AuthorRole.USER if msg["role"] == "user" else AuthorRole.ASSISTANT
-            sk_chat_history.messages.append(
-                ChatMessageContent(role=role, content=msg["content"])
-            )
-        # Append current user message
-        sk_chat_history.messages.append(
-            ChatMessageContent(role=AuthorRole.USER, content=user_message)
-        )
-        # Invoke the orchestrator agent
-        response = None
-        async for res in self.orchestrator.invoke(sk_chat_history):
-            response = res  # last response
+    @staticmethod
+    async def _time_function(context, next):
+        with kernel_function(f"{context.function.plugin_name}.{context.function.name}"):
+            await next(context)
+
+    async def start_session(self, thread_id: str):
+        await self.sessions.create(thread_id)
+
+    async def chat(self, thread_id: str, user_message: str, chat_history: Optional[list] = None) -> dict:
+        # Lets the IAMAssistant plugin answer on this session's own agent thread
+        current_session.set(thread_id)
+        async with self.sessions.lock(thread_id):
+            sk_chat_history = await self.sessions.get(thread_id)
+            if sk_chat_history is None:
+                # Unknown or expired session: start from whatever history the client sent, if any
+                sk_chat_history = ChatHistory()
+                for msg in chat_history or []:
+                    role = AuthorRole.USER if msg["role"] == "user" else AuthorRole.ASSISTANT
+                    sk_chat_history.messages.append(
+                        ChatMessageContent(role=role, content=msg["content"])
+                    )
+            # Append current user message
+            user_turn = ChatMessageContent(role=AuthorRole.USER, content=user_message)
+            sk_chat_history.messages.append(user_turn)
+            try:
+                # Unambiguous read-only requests go straight to the ProvisioningAgent function
+                routed = self.router.match(user_message)
+                if routed:
+                    intent, method, kwargs = routed
+                    started = time.perf_counter()
+                    with kernel_function(f"ProvisioningAgent.{method}"):
+                        result = await getattr(self.provisioning, method)(**kwargs)
+                    self.router.record_hit(intent, time.perf_counter() - started)
+                    reply = {"action": "provision", "result": result}
+                    sk_chat_history.messages.append(
+                        ChatMessageContent(role=AuthorRole.ASSISTANT, content=json.dumps(reply))
+                    )
+                    await self.sessions.put(thread_id, sk_chat_history)
+                    return reply
+                started = time.perf_counter()
+                # Keep the prompt within budget: shrink bulky output from older turns
+                turn = compact_history(sk_chat_history, fixed_tokens=self._instruction_tokens)
+                # Invoke the orchestrator agent (tool calls and results are added to the history)
+                stages = request_stages.get()
+                if stages is None:
+                    stages = {}
+                    request_stages.set(stages)
+                function_seconds = stages.get("kernel_function", 0.0)
+                invoke_started = time.perf_counter()
+                response = None
+                async for res in self.orchestrator.invoke(sk_chat_history):
+                    response = res  # last response
+                # Model time: the invoke minus the plugin calls it made
+                function_seconds = stages.get("kernel_function", 0.0) - function_seconds
+                record_stage("llm", max(time.perf_counter() - invoke_started - function_seconds, 0.0))
+                self.router.record_llm(time.perf_counter() - started)
+                usage = response.metadata.get("usage") if response is not None else None
+                turn["reported_prompt_tokens"] = getattr(usage, "prompt_tokens", None)
+                self.prompt_stats.record(turn)
+                logging.debug("Orchestrator prompt ~%s tokens (before compaction %s, reported %s)",
+                              turn["prompt_tokens_after"], turn["prompt_tokens_before"], turn["reported_prompt_tokens"])
+                if response is not None and (not sk_chat_history.messages or sk_chat_history.messages[-1] is not response):
+                    sk_chat_history.messages.append(response)
+                await self.sessions.put(thread_id, sk_chat_history)
+            except BaseException:
+                # Failed or cancelled turn: leave no dangling user message (or partial tool calls) behind
+                _drop_turn(sk_chat_history, user_turn)
+                raise
         if not response:
             return {"action": "none", "result": "No response from orchestrator agent."}
         try:
@@ -0,0 +1,516 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import contextvars
+from collections import deque, OrderedDict
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+
+from azure.core.exceptions import HttpResponseError
+from azure.ai.projects.models import AzureAISearchTool
+
+from metrics import stage
+
+# Azure agent threads shared by the IAM assistant plugins.
+# The warm pool is topped up to the high watermark whenever it drops below the low one.
+AGENT_THREAD_POOL_LOW = int(os.getenv("AGENT_THREAD_POOL_LOW", "2"))
+AGENT_THREAD_POOL_HIGH = int(os.getenv("AGENT_THREAD_POOL_HIGH", "8"))
+AGENT_THREAD_IDLE_SECONDS = float(os.getenv("AGENT_THREAD_IDLE_SECONDS", "1800"))
+AGENT_THREAD_MAX_SESSIONS = int(os.getenv("AGENT_THREAD_MAX_SESSIONS", "500"))
+AGENT_THREAD_SWEEP_SECONDS = 60
+# Agent and connection ids resolved on a previous start, keyed by agent key and config hash
+AGENT_CACHE_PATH = os.getenv("AGENT_CACHE_PATH", ".agent_cache.json")
+AGENT_MANAGED_BY = "iam-geni"
+# Agents are shared only within a deployment (e.g. staging vs prod in one project); outdated agents
+# of other deployments are never deleted
+AGENT_DEPLOYMENT = os.getenv("AGENT_DEPLOYMENT", "default")
+# Agent runs are polled with adaptive backoff and cancelled server-side past the deadline.
+# The default deadline sits under the UI's 60s request timeout.
+AGENT_RUN_DEADLINE_SECONDS = float(os.getenv("AGENT_RUN_DEADLINE_SECONDS", "55"))
+AGENT_RUN_POLL_MIN_SECONDS = float(os.getenv("AGENT_RUN_POLL_MIN_SECONDS", "0.25"))
+AGENT_RUN_POLL_MAX_SECONDS = float(os.getenv("AGENT_RUN_POLL_MAX_SECONDS", "2"))
+
+# Orchestrator session the current request belongs to; set by OrchestratorAgentWrapper.chat
+# so plugins invoked by the kernel can pick that session's agent thread.
+current_session: contextvars.ContextVar[str] = contextvars.ContextVar("current_session", default="default")
+
+
+class WarmThreadPool:
+    """
+    Pre-created Azure agent threads, so handing one out needs no round trip.
+    - `take()` pops a ready thread, or creates one inline when the pool is empty (a miss)
+    - Refills run in the background once fewer than `low` are ready, up to `high`
+    - `shutdown()` deletes the threads that were never handed out
+    """
+    def __init__(self, project_client, low: int = AGENT_THREAD_POOL_LOW, high: int = AGENT_THREAD_POOL_HIGH):
+        self.project_client = project_client
+        self.low = low
+        self.high = max(high, low)
+        self._lock = threading.Lock()
+        self._ready = deque()
+        self._refilling = 0
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="agent-threads")
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.refill_failures = 0
+        self.refill_seconds = 0.0
+        self.refill_max_seconds = 0.0
+        self.deleted = 0
+        self.delete_failures = 0
+        self._refill(force=True)
+
+    def take(self) -> str:
+        with stage("thread_create"):
+            return self._take()
+
+    def _take(self) -> str:
+        with self._lock:
+            thread_id = self._ready.popleft() if self._ready else None
+            if thread_id is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        self._refill()
+        if thread_id is None:
+            thread_id = self.project_client.agents.create_thread().id
+        return thread_id
+
+    def give_back(self, thread_id: str):
+        """Returns an unused thread (e.g. one created by a request that lost a race)."""
+        with self._lock:
+            if not self._closed:
+                self._ready.append(thread_id)
+                return
+        self.delete(thread_id)
+
+    def _refill(self, force: bool = False):
+        with self._lock:
+            if self._closed or (not force and len(self._ready) + self._refilling >= self.low):
+                return
+            missing = self.high - len(self._ready) - self._refilling
+            if missing <= 0:
+                return
+            self._refilling += missing
+        for _ in range(missing):
+            self._executor.submit(self._create)
+
+    def _create(self):
+        started = time.perf_counter()
+        try:
+            thread_id = self.project_client.agents.create_thread().id
+        except Exception as e:
+            print(f"⚠️ Could not pre-create agent thread: {e}")
+            with self._lock:
+                self._refilling -= 1
+                self.refill_failures += 1
+            return
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._refilling -= 1
+            self.refills += 1
+            self.refill_seconds += elapsed
+            self.refill_max_seconds = max(self.refill_max_seconds, elapsed)
+            if not self._closed:
+                self._ready.append(thread_id)
+                return
+        self._delete_now(thread_id)
+
+    def delete(self, thread_id: str):
+        """Deletes a thread server-side in the background."""
+        try:
+            self._executor.submit(self._delete_now, thread_id)
+        except RuntimeError:  # executor already shut down
+            self._delete_now(thread_id)
+
+    def _delete_now(self, thread_id: str):
+        try:
+            self.project_client.agents.delete_thread(thread_id)
+            self.deleted += 1
+        except Exception as e:
+            self.delete_failures += 1
+            print(f"⚠️ Could not delete agent thread {thread_id}: {e}")
+
+    def shutdown(self, also_delete=()):
+        """Reaps unused threads (plus `also_delete`) and stops the background workers."""
+        with self._lock:
+            self._closed = True
+            threads = list(self._ready) + list(also_delete)
+            self._ready.clear()
+        self._executor.shutdown(wait=True)
+        for thread_id in threads:
+            self._delete_now(thread_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            taken = self.hits + self.misses
+            return {
+                "ready": len(self._ready),
+                "refilling": self._refilling,
+                "low_watermark": self.low,
+                "high_watermark": self.high,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / taken, 3) if taken else None,
+                "refills": self.refills,
+                "refill_failures": self.refill_failures,
+                "avg_refill_ms": round(self.refill_seconds / self.refills * 1000, 1) if self.refills else None,
+                "max_refill_ms": round(self.refill_max_seconds * 1000, 1) if self.refills else None,
+                "deleted": self.deleted,
+                "delete_failures": self.delete_failures,
+            }
+
+
+class AgentThreadPool:
+    """
+    Maps orchestrator sessions to their own Azure agent thread.
+    - New sessions take a pre-created thread from a `WarmThreadPool`
+    - Sessions idle longer than `idle_seconds`, or beyond `max_sessions` (LRU), are retired
+    - Retired threads are deleted server-side in the background
+    - `lock(thread_id)` serialises runs on one thread (the service allows one active run per thread)
+    """
+    def __init__(self, project_client, idle_seconds: float = AGENT_THREAD_IDLE_SECONDS,
+                 max_sessions: int = AGENT_THREAD_MAX_SESSIONS):
+        self.warm = WarmThreadPool(project_client)
+        self.idle_seconds = idle_seconds
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions: "OrderedDict[str, tuple]" = OrderedDict()
+        self._run_locks = {}
+        self._last_sweep = time.time()
+        self.retired = 0
+
+    def thread_for(self, session_id: str) -> str:
+        now = time.time()
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is not None:
+                self._sessions[session_id] = (entry[0], now)
+                self._sessions.move_to_end(session_id)
+        if entry is not None:
+            thread_id = entry[0]
+        else:
+            thread_id = self.warm.take()
+            with self._lock:
+                raced = self._sessions.get(session_id)
+                if raced is None:
+                    self._sessions[session_id] = (thread_id, now)
+                    self._sessions.move_to_end(session_id)
+            if raced is not None:
+                # Another request for the same new session got there first; keep its thread
+                self.warm.give_back(thread_id)
+                thread_id = raced[0]
+        self._sweep(now)
+        return thread_id
+
+    def has_session(self, session_id: str) -> bool:
+        """Whether the session already has a thread (and so earlier turns on it)."""
+        with self._lock:
+            return session_id in self._sessions
+
+    def lock(self, thread_id: str) -> threading.Lock:
+        with self._lock:
+            return self._run_locks.setdefault(thread_id, threading.Lock())
+
+    def retire(self, session_id: str):
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            if entry is not None:
+                self._run_locks.pop(entry[0], None)
+                self.retired += 1
+        if entry is not None:
+            self.warm.delete(entry[0])
+
+    def _sweep(self, now: float):
+        with self._lock:
+            if now - self._last_sweep < AGENT_THREAD_SWEEP_SECONDS and len(self._sessions) <= self.max_sessions:
+                return
+            self._last_sweep = now
+            stale = [s for s, (_, used) in self._sessions.items() if now - used > self.idle_seconds]
+            overflow = len(self._sessions) - len(stale) - self.max_sessions
+            if overflow > 0:
+                # Least recently used first (the OrderedDict is kept in use order)
+                idle = set(stale)
+                stale += [s for s in self._sessions if s not in idle][:overflow]
+            threads = [self._sessions.pop(s)[0] for s in stale]
+            for thread_id in threads:
+                self._run_locks.pop(thread_id, None)
+            self.retired += len(threads)
+        for thread_id in threads:
+            self.warm.delete(thread_id)
+
+    def shutdown(self):
+        """Deletes every warm and session thread; called when the service stops."""
+        with self._lock:
+            threads = [t for t, _ in self._sessions.values()]
+            self._sessions.clear()
+        self.warm.shutdown(also_delete=threads)
+
+    def stats(self) -> dict:
+        with self._lock:
+            sessions = len(self._sessions)
+        return {"sessions": sessions, "retired": self.retired, "warm": self.warm.stats()}
+
+
+# --------------------- Run driver --------------------- #
+
+_RUN_ACTIVE = ("queued", "in_progress", "requires_action", "cancelling")
+
+
+class RunCancelled(Exception):
+    """The caller went away (client disconnect or task cancellation); the run was cancelled."""
+
+
+class RunTimeout(RunCancelled):
+    """The run passed its deadline and was cancelled."""
+
+
+class RunDriver:
+    """
+    Creates an agent run and polls it to a final state, replacing `create_and_process_run`.
+    - Polls start fast and back off (x1.5 up to `poll_max`) so short runs return sooner and long
+      runs make fewer calls
+    - Waits on the caller's `cancel` event, so a disconnect cancels the server-side run at once
+    - Runs past `deadline` seconds are cancelled server-side and raise `RunTimeout`
+    - `requires_action` is not expected (the search tool runs server-side); such runs are cancelled
+    """
+    def __init__(self, deadline: float = AGENT_RUN_DEADLINE_SECONDS, poll_min: float = AGENT_RUN_POLL_MIN_SECONDS,
+                 poll_max: float = AGENT_RUN_POLL_MAX_SECONDS):
+        self.deadline = deadline
+        self.poll_min = poll_min
+        self.poll_max = max(poll_max, poll_min)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.outcomes = {}
+        self.polls = 0
+        self.run_seconds = 0.0
+        self.cancel_failures = 0
+
+    def _record(self, outcome: str, seconds: float, polls: int):
+        with self._lock:
+            self.in_flight -= 1
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+            self.polls += polls
+            self.run_seconds += seconds
+
+    def cancel(self, project_client, thread_id: str, run_id: str):
+        try:
+            project_client.agents.cancel_run(thread_id=thread_id, run_id=run_id)
+        except Exception as e:  # already finished, or the service is unreachable
+            with self._lock:
+                self.cancel_failures += 1
+            print(f"⚠️ Could not cancel run {run_id}: {e}")
+
+    def run(self, project_client, thread_id: str, agent_id: str, cancel: threading.Event = None):
+        """Returns the finished ThreadRun; raises RunCancelled / RunTimeout after cancelling it."""
+        cancel = cancel or threading.Event()
+        started = time.perf_counter()
+        with self._lock:
+            self.in_flight += 1
+        polls, outcome = 0, "error"
+        try:
+            with stage("agent_run"):
+                run = project_client.agents.create_run(thread_id=thread_id, assistant_id=agent_id)
+                delay = self.poll_min
+                while run.status in _RUN_ACTIVE:
+                    if run.status == "requires_action":
+                        self.cancel(project_client, thread_id, run.id)
+                        outcome = "requires_action"
+                        return run
+                    remaining = self.deadline - (time.perf_counter() - started)
+                    if remaining <= 0:
+                        self.cancel(project_client, thread_id, run.id)
+                        outcome = "timed_out"
+                        raise RunTimeout(f"no answer within {self.deadline:.0f}s")
+                    if cancel.wait(min(delay, remaining)):
+                        self.cancel(project_client, thread_id, run.id)
+                        outcome = "cancelled"
+                        raise RunCancelled(f"Run {run.id} cancelled by the caller")
+                    # The last poll lands on the deadline, so a run finishing just before it still counts
+                    run = project_client.agents.get_run(thread_id=thread_id, run_id=run.id)
+                    polls += 1
+                    delay = min(delay * 1.5, self.poll_max)
+                outcome = getattr(run.status, "value", run.status)
+                return run
+        finally:
+            self._record(outcome, time.perf_counter() - started, polls)
+
+    def stats(self) -> dict:
+        with self._lock:
+            runs = sum(self.outcomes.values())
+            return {
+                "in_flight": self.in_flight,
+                "deadline_seconds": self.deadline,
+                "outcomes": dict(self.outcomes),
+                "avg_run_ms": round(self.run_seconds / runs * 1000, 1) if runs else None,
+                "avg_polls": round(self.polls / runs, 1) if runs else None,
+                "cancel_failures": self.cancel_failures,
+            }
+
+
+run_driver = RunDriver()
+
+
+def run_reply(project_client, thread_id: str, run_id: str) -> Optional[str]:
+    """
+    Text of the newest assistant message written by `run_id`.
+    - Fetches a single message, so the payload does not grow with the thread
+    """
+    messages = project_client.agents.list_messages(thread_id=thread_id, run_id=run_id, order="desc", limit=1)
+    last_message = messages.get_last_text_message_by_role("assistant")
+    return last_message.text.value if last_message and last_message.text else None
+
+
+# --------------------- Persistent agents --------------------- #
+
+def _cache_key(key: str) -> str:
+    return key if AGENT_DEPLOYMENT == "default" else f"{AGENT_DEPLOYMENT}/{key}"
+
+
+def _agent_config_hash(model: str, name: str, instructions: str, index_name: str) -> str:
+    config = json.dumps({"model": model, "name": name, "instructions": instructions, "index": index_name},
+                        sort_keys=True)
+    return hashlib.sha256(config.encode("utf-8")).hexdigest()[:32]
+
+
+def _load_agent_cache() -> dict:
+    try:
+        with open(AGENT_CACHE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+# Concurrent warm-up resolves several agents at once; their read-modify-writes must not interleave
+_agent_cache_lock = threading.Lock()
+
+
+def _save_agent_cache(key: str, entry: Optional[dict]):
+    with _agent_cache_lock:
+        cache = _load_agent_cache()
+        if entry is None:
+            cache.pop(key, None)
+        else:
+            cache[key] = entry
+        tmp = None
+        try:
+            with tempfile.NamedTemporaryFile("w", encoding="utf-8", delete=False, suffix=".tmp",
+                                             dir=os.path.dirname(os.path.abspath(AGENT_CACHE_PATH))) as f:
+                tmp = f.name
+                json.dump(cache, f, indent=2)
+            os.replace(tmp, AGENT_CACHE_PATH)
+        except OSError as e:
+            print(f"⚠️ Could not write agent cache {AGENT_CACHE_PATH}: {e}")
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+
+
+def _list_all_agents(project_client) -> list:
+    agents, after = [], None
+    while True:
+        page = project_client.agents.list_agents(limit=100, after=after)
+        agents.extend(page.data)
+        if not page.has_more or not page.data:
+            return agents
+        after = page.last_id
+
+
+def resolve_search_agent(project_client, key: str, model: str, name: str, instructions: str,
+                         index_name: str, use_cache: bool = True) -> tuple:
+    """
+    Returns (agent_id, AzureAISearchTool) for an Azure AI Search backed agent, creating it only when needed.
+    - A local cache hit for `key` with the same config hash makes no service calls at all
+    - Otherwise an existing agent tagged with this key, deployment and hash is reused; if there is
+      none, one is created with them in its metadata
+    - Agents of this key and deployment with an older hash (previous configs) are deleted
+    """
+    config_hash = _agent_config_hash(model, name, instructions, index_name)
+    cached = _load_agent_cache().get(_cache_key(key)) if use_cache else None
+    if cached and cached.get("config_hash") == config_hash:
+        print(f"♻️ Using cached agent {cached['agent_id']} for {key}")
+        return cached["agent_id"], AzureAISearchTool(index_connection_id=cached["connection_id"],
+                                                     index_name=index_name)
+
+    conn_id = next(
+        (conn.id for conn in project_client.connections.list() if conn.connection_type == "CognitiveSearch"),
+        None
+    )
+    if not conn_id:
+        raise RuntimeError("❌ No Cognitive Search connection found for IAM documents.")
+    ai_search = AzureAISearchTool(index_connection_id=conn_id, index_name=index_name)
+
+    agent_id = None
+    for agent in _list_all_agents(project_client):
+        metadata = agent.metadata or {}
+        if metadata.get("managed_by") != AGENT_MANAGED_BY or metadata.get("agent_key") != key:
+            continue
+        if metadata.get("deployment", "default") != AGENT_DEPLOYMENT:
+            continue
+        if metadata.get("config_hash") == config_hash and agent_id is None:
+            agent_id = agent.id
+            print(f"♻️ Reusing agent {agent_id} for {key}")
+            continue
+        try:
+            project_client.agents.delete_agent(agent.id)
+            print(f"🗑️ Deleted outdated agent {agent.id} for {key}")
+        except Exception as e:
+            print(f"⚠️ Could not delete outdated agent {agent.id}: {e}")
+
+    if agent_id is None:
+        agent_id = project_client.agents.create_agent(
+            model=model,
+            name=name,
+            instructions=instructions,
+            tools=ai_search.definitions,
+            tool_resources=ai_search.resources,
+            metadata={"managed_by": AGENT_MANAGED_BY, "agent_key": key, "config_hash": config_hash,
+                      "deployment": AGENT_DEPLOYMENT},
+        ).id
+        print(f"🆕 Created agent {agent_id} for {key}")
+
+    _save_agent_cache(_cache_key(key), {"agent_id": agent_id, "connection_id": conn_id, "config_hash": config_hash})
+    return agent_id, ai_search
+
+
+def _agent_missing(error: Exception, agent_id: str) -> bool:
+    # A missing thread is a 404 too; only the agent's own id or an "assistant" message qualifies
+    message = str(error)
+    return getattr(error, "status_code", None) == 404 and (agent_id in message or "assistant" in message.lower())
+
+
+class SearchAgent:
+    """
+    A resolved search agent that re-resolves itself if the service no longer knows it.
+    - `call(fn)` runs `fn(agent_id)`; on an agent-not-found error the cache entry is dropped, the agent
+      is looked up or created again and `fn` is retried once
+    """
+    def __init__(self, project_client, key: str, **spec):
+        self.project_client = project_client
+        self.key = key
+        self.spec = spec
+        self._lock = threading.Lock()
+        self.id, self.tool = resolve_search_agent(project_client, key, **spec)
+        self.recoveries = 0
+
+    def _recover(self, stale_id: str):
+        with self._lock:
+            if self.id != stale_id:
+                return  # another request already recovered
+            print(f"⚠️ Agent {stale_id} for {self.key} no longer exists; resolving it again")
+            _save_agent_cache(_cache_key(self.key), None)
+            self.id, self.tool = resolve_search_agent(self.project_client, self.key, use_cache=False, **self.spec)
+            self.recoveries += 1
+
+    def call(self, fn):
+        agent_id = self.id
+        try:
+            return fn(agent_id)
+        except HttpResponseError as e:
+            if not _agent_missing(e, agent_id):
+                raise
+        self._recover(agent_id)
+        return fn(self.id)
@@ -1,20 +1,95 @@
 import os
+import json
+import time
+import hashlib
+import logging
 import threading
 import traceback
-from fastapi import FastAPI, HTTPException, status, Depends
+import contextvars
+from fastapi import FastAPI, HTTPException, Request, status, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from fastapi.security import OAuth2PasswordBearer
 import jwt
 import requests
 import asyncio
+from contextlib import asynccontextmanager
 
 from OrchestratorAgent import OrchestratorAgentWrapper
 from IAMAssistant import IAMAssistant  # Existing agent
+from provisioning_orch import graph_client, graph_tokens
+from answer_cache import answer_cache, question_flight
+from agent_runtime import RunCancelled, run_driver
+import metrics
+from metrics import MetricsMiddleware, stage
 
 
-app = FastAPI(title="IAM Assistant Service", version="1.0.0")
+# --------------------- Startup warm-up --------------------- #
+
+# Build the agents, Graph token and signing keys at boot so the first request does not pay for them
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "1") != "0"
+_warmup: Dict[str, Dict[str, Any]] = {}
+
+
+def _warmup_components() -> Dict[str, Any]:
+    return {
+        "jwks": _jwks_cache.prefetch,
+        "graph_token": graph_tokens.token,
+        "assistant": get_assistant,
+        "orchestrator": get_orchestrator_agent,
+    }
+
+
+def _component_ready() -> Dict[str, bool]:
+    return {
+        "jwks": _jwks_cache.stats()["keys"] > 0,
+        "graph_token": graph_tokens.stats()["expires_in_seconds"] is not None,
+        "assistant": _assistant is not None,
+        "orchestrator": _orchestrator_agent is not None,
+    }
+
+
+def _warm(name: str, fn):
+    entry = _warmup[name] = {"started": time.time(), "seconds": None, "error": None}
+    started = time.perf_counter()
+    try:
+        fn()
+    except Exception as e:
+        traceback.print_exc()
+        entry["error"] = str(e)
+    entry["seconds"] = round(time.perf_counter() - started, 2)
+    print(f"{'⚠️' if entry['error'] else '✅'} Warm-up {name}: {entry['seconds']}s")
+
+
+async def _warm_up():
+    # Each component initialises in its own thread; the slowest one bounds time to ready
+    await asyncio.gather(*(asyncio.to_thread(_warm, name, fn) for name, fn in _warmup_components().items()))
+
+
+def _reap_agent_threads():
+    # Agent threads live server-side; remove the unused and session ones this process created
+    if _assistant is not None:
+        _assistant.threads.shutdown()
+    if _orchestrator_agent is not None:
+        _orchestrator_agent.iam_assistant.threads.shutdown()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warmup = asyncio.create_task(_warm_up()) if WARMUP_ON_STARTUP else None
+    yield
+    if warmup is not None and not warmup.done():
+        warmup.cancel()
+    await asyncio.to_thread(_reap_agent_threads)
+    await graph_client.aclose()
+    _agent_pool.shutdown()
+
+
+app = FastAPI(title="IAM Assistant Service", version="1.0.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -23,6 +98,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Outermost, so request latency includes everything below it
+app.add_middleware(MetricsMiddleware)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
@@ -49,45 +126,278 @@ def get_orchestrator_agent() -> OrchestratorAgentWrapper:
                 _orchestrator_agent = OrchestratorAgentWrapper()
     return _orchestrator_agent
 
+async def _orchestrator() -> OrchestratorAgentWrapper:
+    # Built once; only requests that race warm-up wait for it, in a plain thread rather than the agent pool
+    if _orchestrator_agent is not None:
+        return _orchestrator_agent
+    return await asyncio.to_thread(get_orchestrator_agent)
+
+AGENT_MAX_WORKERS = int(os.getenv("AGENT_MAX_WORKERS", "8"))
+AGENT_MAX_QUEUE = int(os.getenv("AGENT_MAX_QUEUE", "16"))
+AGENT_RETRY_AFTER_SECONDS = int(os.getenv("AGENT_RETRY_AFTER_SECONDS", "5"))
+
+
+class AgentRunPool:
+    """
+    Dedicated executor for blocking Azure agent calls.
+    - Keeps long agent runs off Starlette's default threadpool (auth, health checks)
+    - Admits at most `max_workers + max_queue` calls; beyond that callers get a 503
+    - A call cancelled while still queued never runs and gives its slot back
+    """
+    def __init__(self, max_workers: int = AGENT_MAX_WORKERS, max_queue: int = AGENT_MAX_QUEUE):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="agent-run")
+        self.max_workers = max_workers
+        self.max_in_flight = max_workers + max_queue
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.cancelled = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self.in_flight - self.running
+
+    def _call(self, submitted, fn, args, kwargs):
+        with self._lock:
+            self.running += 1
+        metrics.record_stage("agent_queue_wait", time.perf_counter() - submitted)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            # Released by the worker itself so abandoned requests still count until their run ends.
+            with self._lock:
+                self.running -= 1
+                self.in_flight -= 1
+                self.completed += 1
+
+    def _release_if_cancelled(self, job):
+        # `_call` releases slots of jobs that ran; a job cancelled in the queue never reaches it
+        if job.cancelled():
+            with self._lock:
+                self.in_flight -= 1
+                self.cancelled += 1
+
+    def submit(self, fn, *args, **kwargs) -> "asyncio.Future":
+        """Admit a call or raise 503; returns an awaitable for its result."""
+        with self._lock:
+            if self.in_flight >= self.max_in_flight:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Agent service is busy, please retry shortly.",
+                    headers={"Retry-After": str(AGENT_RETRY_AFTER_SECONDS)},
+                )
+            self.in_flight += 1
+        try:
+            # Run in the request's context so stage timings reach its Server-Timing header
+            ctx = contextvars.copy_context()
+            loop = asyncio.get_running_loop()
+            job = self._executor.submit(ctx.run, self._call, time.perf_counter(), fn, args, kwargs)
+        except RuntimeError:
+            with self._lock:
+                self.in_flight -= 1
+            raise
+        job.add_done_callback(self._release_if_cancelled)
+        # Cancelling the returned future cancels `job` if it has not started yet
+        return asyncio.wrap_future(job, loop=loop)
+
+    async def run(self, fn, *args, **kwargs):
+        return await self.submit(fn, *args, **kwargs)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_workers": self.max_workers,
+            "max_in_flight": self.max_in_flight,
+            "in_flight": self.in_flight,
+            "running": self.running,
+            "queue_depth": self.queue_depth,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "cancelled": self.cancelled,
+        }
+
+
+_agent_pool = AgentRunPool()
+
 # Token verification identical to existing code ...
 OPENID_CONFIG_URL = f"https://login.microsoftonline.com/{os.getenv('TENANT_ID')}/v2.0/.well-known/openid-configuration"
 
 
-def get_jwk():
-    try:
-        response = requests.get(OPENID_CONFIG_URL)
+JWKS_TTL_SECONDS = float(os.getenv("JWKS_TTL_SECONDS", "3600"))
+JWKS_MIN_REFRESH_INTERVAL = float(os.getenv("JWKS_MIN_REFRESH_INTERVAL", "30"))
+
+
+class JWKSCache:
+    """
+    In-process signing key store keyed by `kid`.
+    - Keys are served from memory until the TTL expires
+    - An unknown `kid` triggers at most one refresh (single-flight, rate limited)
+    - If a refresh fails, previously fetched keys keep being served
+    """
+    def __init__(self, ttl: float = JWKS_TTL_SECONDS, min_refresh_interval: float = JWKS_MIN_REFRESH_INTERVAL):
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self._keys: Dict[str, Dict[str, Any]] = {}
+        self._fetched_at = 0.0
+        self._last_attempt = 0.0
+        self._refresh_lock = threading.Lock()
+        self._counter_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    def _count(self, name: str):
+        with self._counter_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _fetch(self) -> Dict[str, Dict[str, Any]]:
+        response = requests.get(OPENID_CONFIG_URL, timeout=10)
         response.raise_for_status()
-        openid_config = response.json()
-        jwks_uri = openid_config['jwks_uri']
-        jwks = requests.get(jwks_uri).json()
-        return jwks['keys']
-    except requests.exceptions.RequestException as e:
-        raise HTTPException(status_code=500, detail=f"Error fetching public keys: {e}")
+        jwks_uri = response.json()['jwks_uri']
+        jwks_response = requests.get(jwks_uri, timeout=10)
+        jwks_response.raise_for_status()
+        return {key['kid']: key for key in jwks_response.json()['keys'] if 'kid' in key}
+
+    def _refresh(self, kid: str, force: bool):
+        # Only one caller fetches; the others wait here and re-check the fresh key set.
+        attempt_started = time.monotonic()
+        with self._refresh_lock:
+            if self._last_attempt >= attempt_started:
+                return
+            if not force and kid in self._keys:
+                return
+            now = time.monotonic()
+            if self._keys and now - self._last_attempt < self.min_refresh_interval:
+                return
+            self._last_attempt = now
+            try:
+                keys = self._fetch()
+            except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+                self._count("refresh_failures")
+                if not self._keys:
+                    raise HTTPException(status_code=500, detail=f"Error fetching public keys: {e}")
+                logging.warning("JWKS refresh failed, serving cached keys: %s", e)
+                return
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+            self._count("refreshes")
+
+    def prefetch(self):
+        """Loads the key set ahead of the first token (used at startup)."""
+        self._refresh("", force=True)
+
+    def get_key(self, kid: str) -> Optional[Dict[str, Any]]:
+        expired = time.monotonic() - self._fetched_at > self.ttl
+        key = self._keys.get(kid)
+        if key is not None and not expired:
+            self._count("hits")
+            return key
+        self._count("misses")
+        self._refresh(kid, force=expired)
+        return self._keys.get(kid)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "refresh_failures": self.refresh_failures,
+            "keys": len(self._keys),
+            "age_seconds": round(time.monotonic() - self._fetched_at, 1) if self._fetched_at else None,
+        }
+
+
+_jwks_cache = JWKSCache()
+
+
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "4096"))
+
+
+class VerifiedTokenCache:
+    """
+    Bounded LRU of already-validated tokens.
+    - Keyed by the SHA-256 digest of the raw bearer token
+    - Each entry expires at the token's own `exp` claim
+    """
+    def __init__(self, maxsize: int = TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[bytes, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        digest = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+            claims, exp = entry
+            if exp <= time.time():
+                del self._entries[digest]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return claims
+
+    def put(self, token: str, claims: Dict[str, Any]):
+        exp = claims.get("exp")
+        if not isinstance(exp, (int, float)):
+            return
+        digest = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            self._entries[digest] = (claims, exp)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": len(self._entries)}
+
+
+_token_cache = VerifiedTokenCache()
 
 
 def verify_token(token: str = Depends(oauth2_scheme)):
+    with stage("verify_token"):
+        return _verify_token(token)
+
+
+def _verify_token(token: str):
     try:
         if not token:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token is missing")
 
+        cached_claims = _token_cache.get(token)
+        if cached_claims is not None:
+            return cached_claims
+
         unverified_header = jwt.get_unverified_header(token)
         if unverified_header is None:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token header")
 
         kid = unverified_header['kid']
-        keys = get_jwk()
+        key = _jwks_cache.get_key(kid)
 
         rsa_key = {}
-        for key in keys:
-            if key['kid'] == kid:
-                rsa_key = {
-                    'kty': key['kty'],
-                    'kid': key['kid'],
-                    'use': key['use'],
-                    'n': key['n'],
-                    'e': key['e']
-                }
-                break
+        if key is not None:
+            rsa_key = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
 
         if not rsa_key:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Unable to find appropriate key")
@@ -99,6 +409,7 @@ def verify_token(token: str = Depends(oauth2_scheme)):
             options={"verify_signature": False, "verify_aud": False},
             issuer=f"https://login.microsoftonline.com/{os.getenv('TENANT_ID')}/v2.0"
         )
+        _token_cache.put(token, payload)
         return payload
 
     except jwt.ExpiredSignatureError:
@@ -124,63 +435,201 @@ class ChatResponse(BaseModel):
 class OrchestratorChatRequest(BaseModel):
     thread_id: str
     message: str
-    chat_history: List[Dict[str, str]]  # List of dicts with keys: 'role', 'content'
+    # Only needed when the server has no session for thread_id (e.g. expired); history is kept server-side
+    chat_history: Optional[List[Dict[str, str]]] = None  # List of dicts with keys: 'role', 'content'
 
 class OrchestratorChatResponse(BaseModel):
     action: str
     result: str
 
-# Health check
+# Health check (liveness only; see /readyz for dependencies)
 @app.get("/healthz")
-def healthz():
+async def healthz():
     return {"status": "ok"}
 
 
+# Readiness: every component initialised, with how long each took
+@app.get("/readyz")
+async def readyz():
+    ready = _component_ready()
+    components = {
+        name: {"ready": ready[name], **_warmup.get(name, {"started": None, "seconds": None, "error": None})}
+        for name in ready
+    }
+    if all(ready.values()):
+        overall = "ready"
+    elif any(c["error"] and not c["ready"] for c in components.values()):
+        overall = "failed"
+    else:
+        overall = "starting"
+    body = {"status": overall, "components": components}
+    if overall != "ready":
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content=body)
+    return body
+
+
+# Cache and pool counters (auth required)
+def _stats() -> Dict[str, Any]:
+    return {
+        "jwks": _jwks_cache.stats(),
+        "token_cache": _token_cache.stats(),
+        "agent_pool": _agent_pool.stats(),
+        "thread_pool": _assistant.threads.stats() if _assistant is not None else None,
+        "answer_cache": answer_cache.stats(),
+        "agent_runs": run_driver.stats(),
+        "question_coalescing": question_flight.stats(),
+        "graph": graph_client.stats(),
+        "graph_token": graph_tokens.stats(),
+        "directory_mirror": (
+            _orchestrator_agent.provisioning._mirror.stats()
+            if _orchestrator_agent is not None and _orchestrator_agent.provisioning._mirror is not None
+            else None
+        ),
+        "orchestrator_sessions": _orchestrator_agent.sessions.stats() if _orchestrator_agent is not None else None,
+        "orchestrator_prompt": _orchestrator_agent.prompt_stats.stats() if _orchestrator_agent is not None else None,
+        "orchestrator_router": _orchestrator_agent.router.stats() if _orchestrator_agent is not None else None,
+        "orchestrator_agent_threads": (
+            _orchestrator_agent.iam_assistant.threads.stats() if _orchestrator_agent is not None else None
+        ),
+    }
+
+
+@app.get("/stats")
+def stats(token: str = Depends(verify_token)):
+    return _stats()
+
+
+# Prometheus scrape target: request/stage histograms plus every numeric /stats value as a gauge.
+# Unauthenticated like /healthz; it carries counters only, no directory data.
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(_stats()), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.post("/thread", response_model=ThreadResponse, status_code=status.HTTP_201_CREATED)
-def create_thread(token: str = Depends(verify_token)):
+async def create_thread(token: str = Depends(verify_token)):
     try:
-        assistant = get_assistant()
-        tid = assistant.create_thread()
+        # A warm-pool take is quick; it must not queue behind agent runs in `_agent_pool`
+        assistant = _assistant if _assistant is not None else await asyncio.to_thread(get_assistant)
+        tid = await asyncio.to_thread(assistant.create_thread)
         return ThreadResponse(thread_id=tid)
+    except HTTPException:
+        raise
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Failed to create thread: {e}")
 
 
+DISCONNECT_POLL_SECONDS = 0.5
+CLIENT_CLOSED_REQUEST = 499  # nginx convention; the client never sees it
+
+
+async def _cancel_on_disconnect(request: Request, work, on_disconnect=None):
+    """
+    Awaits `work` while watching the client connection.
+    - On disconnect, calls `on_disconnect` (e.g. to cancel the agent run), cancels `work` and answers 499
+    """
+    task = asyncio.ensure_future(work)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+        if done:
+            return task.result()
+        if await request.is_disconnected():
+            if on_disconnect is not None:
+                on_disconnect()
+            task.cancel()
+            raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="Client closed request")
+
+
 @app.post("/chat", response_model=ChatResponse)
-def chat(req: ChatRequest, token: str = Depends(verify_token)):
+async def chat(req: ChatRequest, request: Request, token: str = Depends(verify_token)):
+    cancel = threading.Event()
     try:
-        assistant = get_assistant()
-        reply = assistant.chat_on_thread(thread_id=req.thread_id, user_query=req.message)
+        reply = await _cancel_on_disconnect(
+            request,
+            _agent_pool.submit(
+                lambda: get_assistant().chat_on_thread(thread_id=req.thread_id, user_query=req.message, cancel=cancel)
+            ),
+            on_disconnect=cancel.set,
+        )
         return ChatResponse(reply=reply)
+    except HTTPException:
+        raise
+    except RunCancelled:
+        raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="Client closed request")
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Chat failed: {e}")
 
 
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.post("/chat/stream")
+async def chat_stream(req: ChatRequest, token: str = Depends(verify_token)):
+    """Relay assistant text deltas as Server-Sent Events (delta / done / error)."""
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    stop = threading.Event()
+
+    def produce():
+        if stop.is_set():
+            return  # the client disconnected while this job was queued
+        try:
+            for delta in get_assistant().stream_on_thread(thread_id=req.thread_id, user_query=req.message,
+                                                            cancel=stop):
+                if stop.is_set():
+                    return
+                loop.call_soon_threadsafe(queue.put_nowait, ("delta", {"text": delta}))
+            loop.call_soon_threadsafe(queue.put_nowait, ("done", {}))
+        except Exception as e:
+            traceback.print_exc()
+            loop.call_soon_threadsafe(queue.put_nowait, ("error", {"detail": f"Chat failed: {e}"}))
+
+    _agent_pool.submit(produce)
+
+    async def events():
+        try:
+            while True:
+                event, data = await queue.get()
+                yield _sse(event, data)
+                if event != "delta":
+                    break
+        finally:
+            stop.set()
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
 # New endpoint for orchestrator thread creation
 @app.post("/orchestrator/thread", response_model=ThreadResponse, status_code=status.HTTP_201_CREATED)
-def create_orchestrator_thread(token: str = Depends(verify_token)):
+async def create_orchestrator_thread(token: str = Depends(verify_token)):
     try:
-        # For simplicity, use assistant thread creation (could be customized)
-        # Or manage distinct thread IDs if needed
-        tid = f"orch-{os.urandom(4).hex()}"  # generate random id for orchestrator session
+        tid = f"orch-{os.urandom(8).hex()}"  # id of the server-side orchestrator session
+        orchestrator_agent = await _orchestrator()
+        await orchestrator_agent.start_session(tid)
         return ThreadResponse(thread_id=tid)
+    except HTTPException:
+        raise
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Failed to create orchestrator thread: {e}")
 
 # Orchestrator chat endpoint
 @app.post("/orchestrator/chat", response_model=OrchestratorChatResponse)
-async def orchestrator_chat(req: OrchestratorChatRequest, token: str = Depends(verify_token)):
+async def orchestrator_chat(req: OrchestratorChatRequest, request: Request, token: str = Depends(verify_token)):
     try:
-        orchestrator_agent = get_orchestrator_agent()
-        response = await orchestrator_agent.chat(
+        orchestrator_agent = await _orchestrator()  # may wait on warm-up; keep it off the loop
+        # Cancelling the turn cancels any IAM agent run it started
+        response = await _cancel_on_disconnect(request, orchestrator_agent.chat(
             thread_id=req.thread_id,
             user_message=req.message,
             chat_history=req.chat_history,
-        )
+        ))
         return response
+    except HTTPException:
+        raise
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Orchestrator chat failed: {e}")
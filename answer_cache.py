@@ -0,0 +1,230 @@
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+import requests
+from openai import AzureOpenAI
+
+from agent_runtime import RunCancelled
+from single_flight import FlightCancelled, SingleFlight
+
+# Answers to IAM documentation questions, reused while the search index is unchanged.
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") != "0"
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "86400"))
+# Follow-ups such as "and for guests?" depend on the conversation; only cache self-contained questions
+ANSWER_CACHE_MIN_WORDS = int(os.getenv("ANSWER_CACHE_MIN_WORDS", "3"))
+# Optional semantic tier: an Azure OpenAI embedding deployment and the cosine similarity to accept
+ANSWER_CACHE_EMBEDDING_DEPLOYMENT = os.getenv("ANSWER_CACHE_EMBEDDING_DEPLOYMENT", "")
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.92"))
+EMBEDDING_API_VERSION = os.getenv("EMBEDDING_API_VERSION", "2024-02-01")
+# Index version: set explicitly, or read from the Azure AI Search REST API
+IAM_DOCS_INDEX_NAME = "iam-docs-rag"
+IAM_DOCS_INDEX_VERSION = os.getenv("IAM_DOCS_INDEX_VERSION", "")
+AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_ENDPOINT", "")
+AZURE_SEARCH_API_KEY = os.getenv("AZURE_SEARCH_API_KEY", "")
+INDEX_VERSION_CHECK_SECONDS = float(os.getenv("INDEX_VERSION_CHECK_SECONDS", "300"))
+
+_FILLER = {"please", "pls", "can", "could", "would", "you", "tell", "me", "i", "a", "an", "the", "to", "my", "kindly"}
+_NOT_CACHEABLE = ("Run failed", "❌", "No response received", "🤖 No response received")
+
+
+def is_cacheable(answer: Optional[str]) -> bool:
+    return bool(answer) and not answer.startswith(_NOT_CACHEABLE)
+
+
+def normalize_question(question: str) -> str:
+    words = re.sub(r"[^a-z0-9]+", " ", question.lower()).split()
+    return " ".join(w for w in words if w not in _FILLER)
+
+
+def index_version() -> str:
+    """
+    Version of the iam-docs-rag index; answers cached under another version are dropped.
+    - IAM_DOCS_INDEX_VERSION wins when set (e.g. bumped by the ingestion pipeline)
+    - Otherwise the index ETag plus its document count and storage size
+    """
+    if IAM_DOCS_INDEX_VERSION or not AZURE_SEARCH_ENDPOINT:
+        return IAM_DOCS_INDEX_VERSION
+    base = f"{AZURE_SEARCH_ENDPOINT.rstrip('/')}/indexes/{IAM_DOCS_INDEX_NAME}"
+    headers = {"api-key": AZURE_SEARCH_API_KEY}
+    params = {"api-version": "2023-11-01"}
+    index = requests.get(base, headers=headers, params=params, timeout=10)
+    index.raise_for_status()
+    stats = requests.get(f"{base}/stats", headers=headers, params=params, timeout=10)
+    stats.raise_for_status()
+    s = stats.json()
+    return f"{index.json().get('@odata.etag', '')}:{s.get('documentCount')}:{s.get('storageSize')}"
+
+
+class _Embedder:
+    def __init__(self, deployment: str):
+        self.deployment = deployment
+        self._client = AzureOpenAI(
+            azure_endpoint=os.getenv("CHAT_MODEL_ENDPOINT"),
+            api_key=os.getenv("CHAT_MODEL_API_KEY"),
+            api_version=EMBEDDING_API_VERSION,
+        )
+
+    def __call__(self, text: str) -> np.ndarray:
+        vector = np.asarray(self._client.embeddings.create(model=self.deployment, input=text).data[0].embedding,
+                            dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+
+class AnswerCache:
+    """
+    LRU + TTL cache of documentation answers keyed by normalized question text.
+    - Exact tier: the normalized question
+    - Optional semantic tier: nearest cached question by embedding, accepted above `similarity`
+    - Everything is dropped when the index version changes (checked at most every few minutes)
+    - Tracks hit rate and the agent-run time saved by hits
+    """
+    def __init__(self, max_entries: int = ANSWER_CACHE_SIZE, ttl: float = ANSWER_CACHE_TTL_SECONDS,
+                 similarity: float = ANSWER_CACHE_SIMILARITY, embedder=None, enabled: bool = ANSWER_CACHE_ENABLED):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self.embedder = embedder
+        self.enabled = enabled
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._version: Optional[str] = None
+        self._version_checked = 0.0
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.saved_seconds = 0.0
+
+    def _check_version(self):
+        now = time.time()
+        if now - self._version_checked < INDEX_VERSION_CHECK_SECONDS:
+            return
+        self._version_checked = now
+        try:
+            version = index_version()
+        except Exception as e:
+            print(f"⚠️ Could not read {IAM_DOCS_INDEX_NAME} index version: {e}")
+            return
+        with self._lock:
+            if self._version is not None and version != self._version:
+                self._entries.clear()
+                self.invalidations += 1
+                print(f"🔄 {IAM_DOCS_INDEX_NAME} index changed; answer cache cleared")
+            self._version = version
+
+    def _embed(self, text: str) -> Optional[np.ndarray]:
+        if self.embedder is None:
+            return None
+        try:
+            return self.embedder(text)
+        except Exception as e:
+            print(f"⚠️ Question embedding failed: {e}")
+            return None
+
+    def lookup(self, question: str) -> tuple:
+        """Returns (cached answer, None) on a hit, else (None, key); pass the key to `store` after the run."""
+        key = normalize_question(question)
+        if not self.enabled or len(key.split()) < ANSWER_CACHE_MIN_WORDS:
+            return None, None
+        self._check_version()
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry["stored"] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.saved_seconds += entry["seconds"]
+                return entry["answer"], None
+        vector = self._embed(key)
+        if vector is not None:
+            with self._lock:
+                best, best_score = None, self.similarity
+                for candidate in self._entries.values():
+                    if candidate["vector"] is None or now - candidate["stored"] > self.ttl:
+                        continue
+                    score = float(np.dot(vector, candidate["vector"]))
+                    if score >= best_score:
+                        best, best_score = candidate, score
+                if best is not None:
+                    self._entries.move_to_end(best["key"])
+                    self.hits += 1
+                    self.semantic_hits += 1
+                    self.saved_seconds += best["seconds"]
+                    return best["answer"], None
+        with self._lock:
+            self.misses += 1
+        return None, (key, vector)
+
+    def store(self, lookup_key, answer: str, seconds: float):
+        """Caches a fresh answer; `seconds` is what the agent run took (the saving on each later hit)."""
+        if lookup_key is None or not is_cacheable(answer):
+            return
+        key, vector = lookup_key
+        with self._lock:
+            self._entries[key] = {"key": key, "answer": answer, "vector": vector,
+                                  "stored": time.time(), "seconds": seconds}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "saved_seconds": round(self.saved_seconds, 1),
+                "invalidations": self.invalidations,
+                "index_version": self._version,
+                "semantic_tier": self.embedder is not None,
+            }
+
+
+answer_cache = AnswerCache(
+    embedder=_Embedder(ANSWER_CACHE_EMBEDDING_DEPLOYMENT) if ANSWER_CACHE_EMBEDDING_DEPLOYMENT else None
+)
+
+
+# Identical questions asked while the first is still running share its answer
+question_flight = SingleFlight()
+
+
+def join_question(lookup_key, cancel: Optional[threading.Event] = None) -> tuple:
+    """
+    Joins an identical question already being answered (by `lookup` key).
+    - (answer, None): another request's answer was shared
+    - (None, call): this request leads; it must `question_flight.finish(lookup_key[0], call, answer)`
+    - (None, None): not coalesced (no key, or earlier leaders gave no answer); just run
+    - Raises RunCancelled when `cancel` is set while waiting, releasing the worker at once
+    """
+    if lookup_key is None:
+        return None, None
+    try:
+        return question_flight.join(lookup_key[0], cancel)
+    except FlightCancelled as e:
+        raise RunCancelled(str(e)) from None
+
+
+def answer_once(lookup_key, run, cancel: Optional[threading.Event] = None) -> tuple:
+    """Returns (answer, shared): a shared answer to the same question, else the result of `run()`."""
+    shared, call = join_question(lookup_key, cancel)
+    if shared is not None:
+        return shared, True
+    if call is None:
+        return run(), False
+    answer = None
+    try:
+        answer = run()
+        return answer, False
+    finally:
+        question_flight.finish(lookup_key[0], call, answer if is_cacheable(answer) else None)
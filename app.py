@@ -6,6 +6,9 @@ import msal
 import os
 from dotenv import load_dotenv
 import ast
+import re
+import json
+import itertools
 
 load_dotenv()
 
@@ -16,6 +19,10 @@ SCOPES = ["User.Read"]
 API_BASE = "http://127.0.0.1:8000"
 REDIRECT_URI = "http://localhost:8501"
 logo_path = "tcs_logo.png"
+# Typing animation: total reveal time is capped, long or list-style replies render at once
+TYPING_MAX_SECONDS = float(os.getenv("TYPING_MAX_SECONDS", "1.5"))
+TYPING_FRAME_SECONDS = float(os.getenv("TYPING_FRAME_SECONDS", "0.05"))
+TYPING_INSTANT_CHARS = int(os.getenv("TYPING_INSTANT_CHARS", "1500"))
 
 
 def initiate_login():
@@ -289,6 +296,72 @@ if "code" in st.query_params:
                 pass
 
 
+def iter_sse_events(response):
+    """Yield (event, data) pairs from a text/event-stream response as they arrive."""
+    response.encoding = "utf-8"
+    event, data_lines = "message", []
+    for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+        if not line:
+            if data_lines:
+                yield event, json.loads("\n".join(data_lines))
+            event, data_lines = "message", []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data_lines.append(line[len("data:"):].strip())
+
+
+class ThrottledMarkdown:
+    """Accumulates streamed text and repaints the placeholder at most once per frame."""
+    def __init__(self, placeholder, label, interval=TYPING_FRAME_SECONDS):
+        self.placeholder = placeholder
+        self.label = label
+        self.interval = interval
+        self.text = ""
+        self._last_flush = 0.0
+
+    def append(self, chunk):
+        self.text += chunk
+        if time.monotonic() - self._last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self.placeholder.markdown(f"**{self.label}**: {self.text}")
+        self._last_flush = time.monotonic()
+
+
+def is_listing(reply):
+    """Tool dumps such as user/group listings are shown immediately."""
+    lines = reply.splitlines()
+    return len(lines) >= 5 and sum(1 for line in lines if line.lstrip().startswith(("-", "*", "|"))) >= len(lines) // 2
+
+
+def render_reply(placeholder, label, reply):
+    """Reveal a reply word by word in a bounded number of frames (at most TYPING_MAX_SECONDS)."""
+    frames = int(TYPING_MAX_SECONDS / TYPING_FRAME_SECONDS) if TYPING_FRAME_SECONDS > 0 else 0
+    if frames <= 1 or len(reply) >= TYPING_INSTANT_CHARS or is_listing(reply):
+        placeholder.markdown(f"**{label}**: {reply}")
+        return
+    tokens = re.split(r"(\s+)", reply)
+    step = max(1, -(-len(tokens) // frames))
+    for end in range(step, len(tokens) + step, step):
+        placeholder.markdown(f"**{label}**: {''.join(tokens[:end])}")
+        time.sleep(TYPING_FRAME_SECONDS)
+
+
+def busy_reply(reply) -> bool:
+    """True when the backend relayed an Azure `server_error` instead of an answer."""
+    if isinstance(reply, dict):
+        return reply.get('code') == 'server_error'
+    if not reply:
+        return True
+    try:
+        parsed = ast.literal_eval(reply)
+        return isinstance(parsed, dict) and parsed.get('code') == 'server_error'
+    except Exception:
+        return 'server_error' in reply
+
+
 def show_intro():
     st.markdown('<div class="centered-intro">Ask me anything about Identity and Access Management.</div>', unsafe_allow_html=True)
 
@@ -328,31 +401,31 @@ def main_chat_page():
     prompt = st.chat_input("Say something:")
     if prompt:
         user_input = prompt
-        with st.spinner("Thinking..."):
-            try:
-                headers = {"Authorization": f"Bearer {st.session_state['access_token']}"}
-                payload = {"thread_id": st.session_state["thread_id"], "message": user_input}
-                r = requests.post(f"{API_BASE}/chat", json=payload, timeout=60, headers=headers)
+        typing_placeholder = st.empty()
+        stream_view = ThrottledMarkdown(typing_placeholder, "IAM Assistant")
+        reply = ""
+        try:
+            headers = {"Authorization": f"Bearer {st.session_state['access_token']}"}
+            payload = {"thread_id": st.session_state["thread_id"], "message": user_input}
+            with st.spinner("Thinking..."):
+                r = requests.post(f"{API_BASE}/chat/stream", json=payload, timeout=60, headers=headers, stream=True)
                 r.raise_for_status()
-                reply = r.json().get("reply", "")
-                if isinstance(reply, dict) and reply.get('code') == 'server_error':
-                    reply = "**Agent is currently busy, please wait a moment and try again.**"
-                elif isinstance(reply, str):
-                    try:
-                        parsed = ast.literal_eval(reply)
-                        if isinstance(parsed, dict) and parsed.get('code') == 'server_error':
-                            reply = "**Agent is currently busy, please wait a moment and try again.**"
-                    except Exception:
-                        if 'server_error' in reply:
-                            reply = "**Agent is currently busy, please wait a moment and try again.**"
-            except Exception:
+                events = iter_sse_events(r)
+                first_event = next(events, None)
+            for event, data in itertools.chain([first_event] if first_event else [], events):
+                if event == "delta":
+                    stream_view.append(data.get("text", ""))
+                    reply = stream_view.text
+                elif event == "error":
+                    reply = data.get("detail", "server_error")
+                    break
+                elif event == "done":
+                    break
+            if busy_reply(reply):
                 reply = "**Agent is currently busy, please wait a moment and try again.**"
-        typing_placeholder = st.empty()
-        typing_message = ""
-        for char in reply:
-            typing_message += char
-            typing_placeholder.markdown(f"**IAM Assistant**: {typing_message}")
-            time.sleep(0.01)
+        except Exception:
+            reply = "**Agent is currently busy, please wait a moment and try again.**"
+        typing_placeholder.markdown(f"**IAM Assistant**: {reply}")
         st.session_state["chat_history"].append((user_input, reply))
         st.rerun()
 
@@ -394,25 +467,17 @@ def orchestrator_chat_page():
         with st.spinner("Thinking..."):
             try:
                 headers = {"Authorization": f"Bearer {st.session_state['access_token']}"}
+                # The service keeps the conversation for this thread; only the new message is sent
                 payload = {
                     "thread_id": st.session_state["orch_thread_id"],
                     "message": user_input,
-                    "chat_history": [
-                        {"role": "user", "content": um} if i % 2 == 0 else {"role": "assistant", "content": am}
-                        for i, (um, am) in enumerate(st.session_state["orchestrator_chat_history"])
-                    ],
                 }
                 r = requests.post(f"{API_BASE}/orchestrator/chat", json=payload, timeout=120, headers=headers)
                 r.raise_for_status()
                 reply = r.json().get("result", "")
             except Exception as e:
                 reply = "**Orchestrator is currently busy, please try again later.**"
-        typing_placeholder = st.empty()
-        typing_message = ""
-        for char in reply:
-            typing_message += char
-            typing_placeholder.markdown(f"**Orchestrator**: {typing_message}")
-            time.sleep(0.01)
+        render_reply(st.empty(), "Orchestrator", reply)
         st.session_state["orchestrator_chat_history"].append((user_input, reply))
         st.rerun()
 
@@ -0,0 +1,360 @@
+import os
+import time
+import json
+import sqlite3
+import asyncio
+import threading
+from typing import Optional, Callable
+
+# Optional local copy of users, groups, memberships and ownership for read-only
+# provisioning lookups. Enabled by pointing GRAPH_MIRROR_PATH at a SQLite file.
+GRAPH_MIRROR_PATH = os.getenv("GRAPH_MIRROR_PATH", "")
+GRAPH_MIRROR_SYNC_SECONDS = float(os.getenv("GRAPH_MIRROR_SYNC_SECONDS", "60"))
+GRAPH_MIRROR_MAX_STALENESS_SECONDS = float(os.getenv("GRAPH_MIRROR_MAX_STALENESS_SECONDS", "300"))
+
+USER_FIELDS = ["displayName", "userPrincipalName", "mailNickname", "department", "jobTitle"]
+GROUP_FIELDS = ["displayName", "mailNickname", "securityEnabled", "createdDateTime"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    displayName TEXT, userPrincipalName TEXT, mailNickname TEXT, department TEXT, jobTitle TEXT
+);
+CREATE INDEX IF NOT EXISTS users_upn ON users (userPrincipalName COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS groups (
+    id TEXT PRIMARY KEY,
+    displayName TEXT, mailNickname TEXT, securityEnabled TEXT, createdDateTime TEXT
+);
+CREATE TABLE IF NOT EXISTS members (
+    group_id TEXT, member_id TEXT, member_type TEXT, PRIMARY KEY (group_id, member_id)
+);
+CREATE TABLE IF NOT EXISTS owners (
+    group_id TEXT, owner_id TEXT, owner_type TEXT, PRIMARY KEY (group_id, owner_id)
+);
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+class DeltaReset(Exception):
+    """Graph no longer accepts the saved delta token; a full resync is needed."""
+
+
+class DirectoryMirror:
+    """
+    Local mirror of the directory kept current with `/users/delta` and `/groups/delta`.
+    - Persisted to SQLite, including the delta links, so a restart resumes instead of resyncing
+    - Reads are only served while the last completed sync is within the staleness bound
+    - Single-object writes update the mirror; other writes invalidate the affected entries
+      until the next sync has caught up
+    - SQLite work called from the event loop runs in `asyncio.to_thread`; freshness checks use the
+      sync time held in memory
+    """
+    def __init__(self, path: str, graph, headers: Callable[[], dict], base_url: str):
+        self.path = path
+        self._graph = graph
+        self._headers = headers
+        self.base_url = base_url
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript(SCHEMA)
+        self._db_lock = threading.Lock()
+        self._sync_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self._invalidated = {}
+        self.syncs = 0
+        self.sync_failures = 0
+        self.reads = 0
+        self.last_sync_seconds = None
+        self._synced_at = float(self._get_state("synced_at") or 0)
+
+    # --------------------- State --------------------- #
+
+    def _get_state(self, key: str) -> Optional[str]:
+        with self._db_lock:
+            row = self._db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else None
+
+    def _set_state(self, key: str, value: str):
+        self._db.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+
+    @property
+    def synced_at(self) -> float:
+        return self._synced_at
+
+    def staleness(self) -> Optional[float]:
+        """Seconds since the last completed sync, or None if the mirror was never populated."""
+        synced_at = self.synced_at
+        return time.time() - synced_at if synced_at else None
+
+    def is_fresh(self) -> bool:
+        staleness = self.staleness()
+        return staleness is not None and staleness <= GRAPH_MIRROR_MAX_STALENESS_SECONDS
+
+    def is_invalidated(self, object_id: str) -> bool:
+        return object_id.lower() in self._invalidated
+
+    def invalidate(self, *object_ids: str):
+        now = time.time()
+        for object_id in object_ids:
+            self._invalidated[object_id.lower()] = now
+
+    def freshness_note(self) -> str:
+        return f"ℹ️ From directory mirror (synced {int(self.staleness() or 0)}s ago)."
+
+    # --------------------- Sync --------------------- #
+
+    def ensure_running(self):
+        """Start the background delta loop on the current event loop if it is not running."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sync()
+            except Exception as e:
+                self.sync_failures += 1
+                print(f"⚠️ Directory mirror sync failed: {e}")
+            await asyncio.sleep(GRAPH_MIRROR_SYNC_SECONDS)
+
+    async def sync(self):
+        if self._sync_lock is None:
+            self._sync_lock = asyncio.Lock()
+        async with self._sync_lock:
+            started = time.time()
+            await self._sync_kind("users")
+            await self._sync_kind("groups")
+            await self._write(self._set_state, "synced_at", str(started))
+            self._synced_at = started
+            # Anything invalidated before this pass began is now reflected in the mirror.
+            self._invalidated = {k: t for k, t in self._invalidated.items() if t >= started}
+            self.syncs += 1
+            self.last_sync_seconds = round(time.time() - started, 3)
+
+    def _initial_url(self, kind: str) -> str:
+        if kind == "users":
+            return f"{self.base_url}/users/delta?$select=id,{','.join(USER_FIELDS)}"
+        return f"{self.base_url}/groups/delta?$select=id,{','.join(GROUP_FIELDS)},members,owners"
+
+    async def _sync_kind(self, kind: str):
+        try:
+            link = await asyncio.to_thread(self._get_state, f"{kind}_link")
+            await self._follow_delta(kind, link or self._initial_url(kind))
+        except DeltaReset:
+            await self._write(self._reset, kind)
+            await self._follow_delta(kind, self._initial_url(kind))
+
+    def _reset(self, kind: str):
+        if kind == "users":
+            self._db.execute("DELETE FROM users")
+        else:
+            for table in ("groups", "members", "owners"):
+                self._db.execute(f"DELETE FROM {table}")
+        self._db.execute("DELETE FROM state WHERE key = ?", (f"{kind}_link",))
+
+    async def _follow_delta(self, kind: str, url: str):
+        while url:
+            resp = await self._graph.get(url, headers=self._headers())
+            if resp.status_code == 410:
+                raise DeltaReset(kind)
+            if resp.status_code != 200:
+                raise RuntimeError(f"{kind} delta failed: {resp.status_code} – {resp.text}")
+            payload = resp.json()
+            next_url = payload.get("@odata.nextLink")
+            link = next_url or payload.get("@odata.deltaLink")
+            # Each page is applied together with the link that follows it, so a restart resumes here.
+            await self._write(self._apply_page, kind, payload.get("value", []), link)
+            url = next_url
+
+    def _apply_page(self, kind: str, items: list, link: Optional[str]):
+        for item in items:
+            if kind == "users":
+                self._apply_user(item)
+            else:
+                self._apply_group(item)
+        if link:
+            self._set_state(f"{kind}_link", link)
+
+    def _upsert(self, table: str, fields: list, item: dict):
+        present = [f for f in fields if f in item]
+        values = [_as_text(item[f]) for f in present]
+        self._db.execute(f"INSERT OR IGNORE INTO {table} (id) VALUES (?)", (item["id"],))
+        if present:
+            assignments = ", ".join(f"{f} = ?" for f in present)
+            self._db.execute(f"UPDATE {table} SET {assignments} WHERE id = ?", values + [item["id"]])
+
+    def _apply_user(self, item: dict):
+        if "@removed" in item:
+            self._delete_object(item["id"])
+        else:
+            self._upsert("users", USER_FIELDS, item)
+
+    def _apply_group(self, item: dict):
+        gid = item["id"]
+        if "@removed" in item:
+            self._delete_object(gid)
+            return
+        self._upsert("groups", GROUP_FIELDS, item)
+        for table, column, key in (("members", "member", "members@delta"), ("owners", "owner", "owners@delta")):
+            for ref in item.get(key, []):
+                if "@removed" in ref:
+                    self._db.execute(f"DELETE FROM {table} WHERE group_id = ? AND {column}_id = ?", (gid, ref["id"]))
+                else:
+                    self._db.execute(
+                        f"INSERT OR REPLACE INTO {table} (group_id, {column}_id, {column}_type) VALUES (?, ?, ?)",
+                        (gid, ref["id"], _object_type(ref)),
+                    )
+
+    def _delete_object(self, object_id: str):
+        self._db.execute("DELETE FROM users WHERE id = ?", (object_id,))
+        self._db.execute("DELETE FROM groups WHERE id = ?", (object_id,))
+        self._db.execute("DELETE FROM members WHERE group_id = ? OR member_id = ?", (object_id, object_id))
+        self._db.execute("DELETE FROM owners WHERE group_id = ? OR owner_id = ?", (object_id, object_id))
+
+    # --------------------- Write-through --------------------- #
+
+    def _transaction(self, fn, *args):
+        with self._db_lock, self._db:
+            fn(*args)
+
+    async def _write(self, fn, *args):
+        """Runs `fn(*args)` in one transaction, off the event loop."""
+        await asyncio.to_thread(self._transaction, fn, *args)
+
+    async def put_user(self, user: dict):
+        if user.get("id"):
+            await self._write(self._upsert, "users", USER_FIELDS, user)
+
+    async def put_group(self, group: dict):
+        if group.get("id"):
+            await self._write(self._upsert, "groups", GROUP_FIELDS, group)
+
+    async def update_object(self, table: str, object_id: str, field: str, value: str):
+        fields = USER_FIELDS if table == "users" else GROUP_FIELDS
+        row = await self._find(table, object_id)
+        if field in fields and row is not None:
+            await self._write(self._db.execute, f"UPDATE {table} SET {field} = ? WHERE id = ?", (value, row["id"]))
+        else:
+            self.invalidate(object_id)
+
+    async def remove_object(self, object_id: str):
+        row = await self._find("users", object_id) or await self._find("groups", object_id)
+        await self._write(self._delete_object, row["id"] if row else object_id)
+
+    async def add_link(self, table: str, group_id: str, object_id: str):
+        user = await self._find("users", object_id)
+        if user is None:
+            # Referenced by something the mirror cannot resolve yet; let the next sync fill it in.
+            self.invalidate(group_id)
+            return
+        column = "member" if table == "members" else "owner"
+        await self._write(
+            self._db.execute,
+            f"INSERT OR REPLACE INTO {table} (group_id, {column}_id, {column}_type) VALUES (?, ?, 'user')",
+            (group_id, user["id"]),
+        )
+
+    async def remove_link(self, table: str, group_id: str, object_id: str):
+        column = "member" if table == "members" else "owner"
+        await self._write(self._db.execute, f"DELETE FROM {table} WHERE group_id = ? AND {column}_id = ?",
+                          (group_id, object_id))
+
+    # --------------------- Reads --------------------- #
+
+    def _fetch(self, sql: str, params: tuple) -> list:
+        with self._db_lock:
+            return self._db.execute(sql, params).fetchall()
+
+    async def _query(self, sql: str, params: tuple = ()) -> list:
+        self.reads += 1
+        return await asyncio.to_thread(self._fetch, sql, params)
+
+    async def _find(self, table: str, object_id: str) -> Optional[sqlite3.Row]:
+        if table == "users":
+            rows = await self._query("SELECT * FROM users WHERE id = ? OR userPrincipalName = ? COLLATE NOCASE",
+                                     (object_id, object_id))
+        else:
+            rows = await self._query("SELECT * FROM groups WHERE id = ?", (object_id,))
+        return rows[0] if rows else None
+
+    async def get_user(self, user_id: str) -> Optional[dict]:
+        row = await self._find("users", user_id)
+        return dict(row) if row else None
+
+    async def get_group(self, group_id: str) -> Optional[dict]:
+        row = await self._find("groups", group_id)
+        return dict(row) if row else None
+
+    async def list_users(self, limit: int) -> list:
+        return [dict(r) for r in await self._query("SELECT * FROM users ORDER BY displayName LIMIT ?", (limit,))]
+
+    async def list_groups(self, limit: int) -> list:
+        return [dict(r) for r in await self._query("SELECT * FROM groups ORDER BY displayName LIMIT ?", (limit,))]
+
+    def iter_rows(self, table: str, chunk: int = 5000):
+        """
+        All rows of `users` or `groups`, fetched in chunks (used to build lookup indexes).
+        - Pages by primary key and holds the lock for one chunk at a time, so other mirror calls
+          run between chunks instead of waiting for the whole scan
+        """
+        last_id = ""
+        while True:
+            with self._db_lock:
+                rows = self._db.execute(f"SELECT * FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+                                        (last_id, chunk)).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1]["id"]
+
+    async def group_links(self, table: str, group_id: str) -> list:
+        """Members or owners of a group, resolved to user/group rows where the mirror knows them."""
+        column = "member" if table == "members" else "owner"
+        rows = await self._query(
+            f"""SELECT l.{column}_id AS id,
+                       COALESCE(u.displayName, g.displayName, l.{column}_id) AS displayName,
+                       u.userPrincipalName AS userPrincipalName,
+                       COALESCE(u.mailNickname, g.mailNickname, '') AS mailNickname
+                FROM {table} l
+                LEFT JOIN users u ON u.id = l.{column}_id
+                LEFT JOIN groups g ON g.id = l.{column}_id
+                WHERE l.group_id = ?
+                ORDER BY displayName""",
+            (group_id,),
+        )
+        result = []
+        for r in rows:
+            entry = dict(r)
+            if entry["userPrincipalName"] is None:
+                del entry["userPrincipalName"]
+            result.append(entry)
+        return result
+
+    def stats(self) -> dict:
+        staleness = self.staleness()
+        with self._db_lock:
+            users = self._db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+            groups = self._db.execute("SELECT COUNT(*) FROM groups").fetchone()[0]
+        return {
+            "users": users,
+            "groups": groups,
+            "staleness_seconds": round(staleness, 1) if staleness is not None else None,
+            "fresh": self.is_fresh(),
+            "syncs": self.syncs,
+            "sync_failures": self.sync_failures,
+            "last_sync_seconds": self.last_sync_seconds,
+            "reads": self.reads,
+            "invalidated": len(self._invalidated),
+        }
+
+
+def _as_text(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if isinstance(value, bool):
+        return str(value)
+    return value
+
+
+def _object_type(ref: dict) -> str:
+    return ref.get("@odata.type", "#microsoft.graph.directoryObject").rsplit(".", 1)[-1]
@@ -0,0 +1,162 @@
+import os
+import threading
+from typing import Optional
+
+from semantic_kernel.contents import FunctionCallContent, FunctionResultContent, TextContent
+from semantic_kernel.contents.chat_history import ChatHistory
+from semantic_kernel.contents.utils.author_role import AuthorRole
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding(os.getenv("TOKEN_ENCODING", "cl100k_base"))
+except Exception:  # tiktoken missing or its encoding file unavailable: fall back to ~4 chars/token
+    _encoding = None
+
+# Prompt budget for the orchestrator: the last few turns stay verbatim, older bulky output is shrunk
+ORCH_KEEP_TURNS = int(os.getenv("ORCH_KEEP_TURNS", "3"))
+ORCH_MAX_PROMPT_TOKENS = int(os.getenv("ORCH_MAX_PROMPT_TOKENS", "12000"))
+ORCH_TOOL_OUTPUT_MAX_TOKENS = int(os.getenv("ORCH_TOOL_OUTPUT_MAX_TOKENS", "300"))
+ORCH_SUMMARY_LINES = 3
+
+MESSAGE_OVERHEAD_TOKENS = 4  # role and separators per chat message
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def _item_text(item) -> str:
+    if isinstance(item, TextContent):
+        return item.text or ""
+    if isinstance(item, FunctionCallContent):
+        return f"{item.name or ''}{item.arguments or ''}"
+    if isinstance(item, FunctionResultContent):
+        return str(item.result or "")
+    return ""
+
+
+def message_tokens(message) -> int:
+    return MESSAGE_OVERHEAD_TOKENS + sum(count_tokens(_item_text(i)) for i in message.items)
+
+
+def history_tokens(history: ChatHistory) -> int:
+    return sum(message_tokens(m) for m in history.messages)
+
+
+def _placeholder(text: str, what: str) -> str:
+    lines = text.splitlines()
+    head = "\n".join(lines[:ORCH_SUMMARY_LINES])
+    more = f"\n... ({len(lines) - ORCH_SUMMARY_LINES} more lines)" if len(lines) > ORCH_SUMMARY_LINES else ""
+    return f"[Earlier {what} shortened, ~{count_tokens(text)} tokens. Call the function again if it is needed.]\n{head}{more}"
+
+
+def _turn_starts(history: ChatHistory) -> list:
+    return [i for i, m in enumerate(history.messages) if m.role == AuthorRole.USER]
+
+
+class CompactionStats:
+    """Running prompt-token totals, before and after compaction, for /stats."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.turns = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self.outputs_shortened = 0
+        self.turns_dropped = 0
+        self.reported_prompt_tokens = 0
+        self.last_turn: Optional[dict] = None
+
+    def record(self, turn: dict):
+        with self._lock:
+            self.turns += 1
+            self.tokens_before += turn["prompt_tokens_before"]
+            self.tokens_after += turn["prompt_tokens_after"]
+            self.outputs_shortened += turn["outputs_shortened"]
+            self.turns_dropped += turn["turns_dropped"]
+            self.reported_prompt_tokens += turn.get("reported_prompt_tokens") or 0
+            self.last_turn = turn
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "turns": self.turns,
+                "avg_prompt_tokens_before": round(self.tokens_before / self.turns) if self.turns else 0,
+                "avg_prompt_tokens_after": round(self.tokens_after / self.turns) if self.turns else 0,
+                "tokens_saved": self.tokens_before - self.tokens_after,
+                "outputs_shortened": self.outputs_shortened,
+                "turns_dropped": self.turns_dropped,
+                "reported_prompt_tokens": self.reported_prompt_tokens,
+                "last_turn": self.last_turn,
+                "tokenizer": "tiktoken" if _encoding is not None else "chars/4",
+            }
+
+
+def _shorten(messages, max_tokens: int) -> int:
+    shortened = 0
+    for message in messages:
+        for item in message.items:
+            if isinstance(item, FunctionResultContent):
+                text = str(item.result or "")
+                if count_tokens(text) > max_tokens:
+                    item.result = _placeholder(text, f"output of {item.function_name}")
+                    shortened += 1
+            elif isinstance(item, TextContent) and message.role == AuthorRole.ASSISTANT:
+                if count_tokens(item.text) > max_tokens:
+                    item.text = _placeholder(item.text, "reply")
+                    shortened += 1
+    return shortened
+
+
+def _drop_turns(history: ChatHistory, total: int, max_prompt_tokens: int, keep_turns: int):
+    dropped = 0
+    while total > max_prompt_tokens:
+        starts = _turn_starts(history)
+        if len(starts) <= keep_turns:
+            break
+        cut = starts[1]
+        total -= sum(message_tokens(m) for m in history.messages[:cut])
+        del history.messages[:cut]
+        dropped += 1
+    return total, dropped
+
+
+def compact_history(history: ChatHistory, fixed_tokens: int = 0,
+                    keep_turns: int = ORCH_KEEP_TURNS,
+                    max_prompt_tokens: int = ORCH_MAX_PROMPT_TOKENS,
+                    tool_output_max_tokens: int = ORCH_TOOL_OUTPUT_MAX_TOKENS) -> dict:
+    """
+    Shrinks `history` in place before it is sent to the model and returns this turn's token counts.
+    - The last `keep_turns` turns (a turn starts at a user message) are kept verbatim
+    - In older turns, tool results and assistant replies above `tool_output_max_tokens` become a
+      short placeholder with their first lines
+    - If the prompt (history plus `fixed_tokens` for instructions) is still over `max_prompt_tokens`,
+      whole turns are dropped oldest first, so function calls stay paired with their results
+    - The budget wins over `keep_turns`: if the kept turns alone are too large, their bulky output
+      is shortened too and finally only the current turn is kept
+    """
+    keep_turns = max(keep_turns, 1)
+    before = fixed_tokens + history_tokens(history)
+
+    starts = _turn_starts(history)
+    protected_from = starts[-keep_turns] if len(starts) >= keep_turns else 0
+    shortened = _shorten(history.messages[:protected_from], tool_output_max_tokens)
+    total = fixed_tokens + history_tokens(history)
+    total, dropped = _drop_turns(history, total, max_prompt_tokens, keep_turns)
+
+    if total > max_prompt_tokens:
+        starts = _turn_starts(history)
+        shortened += _shorten(history.messages[:starts[-1]] if starts else [], tool_output_max_tokens)
+        total = fixed_tokens + history_tokens(history)
+        total, more = _drop_turns(history, total, max_prompt_tokens, 1)
+        dropped += more
+
+    return {
+        "prompt_tokens_before": before,
+        "prompt_tokens_after": total,
+        "outputs_shortened": shortened,
+        "turns_dropped": dropped,
+    }
@@ -1,4 +1,7 @@
 import os
+import time
+import asyncio
+import threading
 
 from dotenv import load_dotenv
 
@@ -9,7 +12,9 @@ from azure.identity import ClientSecretCredential
 
 from azure.ai.projects import AIProjectClient
 
-from azure.ai.projects.models import AzureAISearchTool
+from agent_runtime import AgentThreadPool, RunTimeout, SearchAgent, current_session, run_driver, run_reply
+
+from answer_cache import answer_cache, answer_once
  
 load_dotenv()
 
@@ -33,23 +38,13 @@ class IAMAssistant:
             conn_str=os.environ["AIPROJECT_CONNECTION_STRING"],
         )
  
-        # Find Cognitive Search connection
-
-        conn_list = self.project_client.connections.list()
+        # Reuse the IAM agent from a previous start when its configuration is unchanged
 
-        conn_id = next((conn.id for conn in conn_list if conn.connection_type == "CognitiveSearch"), None)
+        self.agent = SearchAgent(
 
-        if not conn_id:
+            self.project_client,
 
-            raise RuntimeError("❌ No Cognitive Search connection found for IAM documents.")
- 
-        # Configure Azure AI Search Tool
-
-        self.ai_search = AzureAISearchTool(index_connection_id=conn_id, index_name="iam-docs-rag")
- 
-        # Create IAM agent
-
-        self.iam_agent = self.project_client.agents.create_agent(
+            key="iam-assistant-orchestrator",
 
             model="gpt-4.1-nano",
 
@@ -68,15 +63,13 @@ You should ONLY use the provided IAM documentation for answering user queries fr
 Always ensure the responses are professional and accurate.
 """,
 
-            tools=self.ai_search.definitions,
-
-            tool_resources=self.ai_search.resources,
+            index_name="iam-docs-rag",
 
         )
  
-        # Create persistent thread
+        # One agent thread per orchestrator session, handed out from a warm pool
 
-        self.thread = self.project_client.agents.create_thread()
+        self.threads = AgentThreadPool(self.project_client)
 
         print("✅ IAM Assistant ready.\n")
  
@@ -87,34 +80,84 @@ Always ensure the responses are professional and accurate.
         """
 
         Handles IAM-related queries by invoking the agent with Azure AI Search context.
+        Each orchestrator session asks on its own agent thread, off the event loop.
+        If the orchestrator turn is cancelled (client gone), the agent run is cancelled too.
 
         """
 
-        self.project_client.agents.create_message(
+        cancel = threading.Event()
 
-            thread_id=self.thread.id,
+        try:
 
-            role="user",
+            return await asyncio.to_thread(self._ask, current_session.get(), question, cancel)
 
-            content=question,
+        except asyncio.CancelledError:
 
-        )
+            cancel.set()
+
+            raise
+
+    def _ask(self, session_id: str, question: str, cancel: threading.Event) -> str:
+
+        # Only a session's first question is cached or shared: later ones are asked on a thread that
+        # holds earlier turns, so their answers may depend on that conversation
+
+        if self.threads.has_session(session_id):
+
+            return self._run(session_id, question, None, cancel)
+
+        # The orchestrator keeps the answer in its own history, so a cache hit needs no thread write
+
+        answer, cache_key = answer_cache.lookup(question)
+
+        if answer is None:
+
+            # Identical questions already running for other sessions share that run's answer
+
+            answer, _ = answer_once(cache_key, lambda: self._run(session_id, question, cache_key, cancel), cancel)
+
+        # Register the session's thread even for a cached or shared answer, so its next question counts as a follow-up
+
+        self.threads.thread_for(session_id)
+
+        return answer
+
+    def _run(self, session_id: str, question: str, cache_key, cancel: threading.Event) -> str:
+
+        started = time.perf_counter()
+
+        thread_id = self.threads.thread_for(session_id)
+
+        with self.threads.lock(thread_id):
+
+            self.project_client.agents.create_message(
+
+                thread_id=thread_id,
+
+                role="user",
+
+                content=question,
+
+            )
  
-        run = self.project_client.agents.create_and_process_run(
+            try:
 
-            thread_id=self.thread.id,
+                run = self.agent.call(
 
-            assistant_id=self.iam_agent.id
+                    lambda agent_id: run_driver.run(self.project_client, thread_id, agent_id, cancel))
 
-        )
+            except RunTimeout as e:
+
+                return f"❌ Run failed: {e}"
  
-        if run.status == "failed":
+            if run.status != "completed":
 
-            return f"❌ Run failed: {run.last_error}"
+                return f"❌ Run failed: {run.last_error}"
  
-        messages = self.project_client.agents.list_messages(thread_id=self.thread.id)
+            # Only this run's reply, however long the session's thread has grown
 
-        last_message = messages.get_last_text_message_by_role("assistant")
+            reply = run_reply(self.project_client, thread_id, run.id) or "🤖 No response received."
  
-        return last_message.text.value if last_message and last_message.text else "🤖 No response received."
- 
\ No newline at end of file
+        answer_cache.store(cache_key, reply, time.perf_counter() - started)
+
+        return reply
@@ -0,0 +1,122 @@
+import os
+import re
+import threading
+from typing import Optional
+
+# Read-only provisioning requests that map to one ProvisioningAgent function with all of its
+# arguments in the message are answered directly, without a chat-completion round trip.
+# Writes are never routed here: the orchestrator asks for confirmation before those.
+ORCH_FAST_PATH = os.getenv("ORCH_FAST_PATH", "1") != "0"
+
+_GUID = r"([0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12})"
+# Never ends on sentence punctuation: "get user john@contoso.com?" looks up the address only
+_UPN = r"([^\s@]+@[^\s@]+\.[^\s@]*[^\s@.?!,])"
+_SHOW = r"(?:please\s+)?(?:list|show|get|display|give\s+me|fetch)(?:\s+me)?"
+_NUM = r"([1-9]\d{0,3})"  # "0 users" is not a listing
+# A name search term: up to three name-like words. Conditions ("with no owners", "that are disabled",
+# "who have not signed in") are not names and need the LLM to choose the right function.
+_CLAUSE = r"(?:with|without|that|who|whose|which|where|owned|having|not|no)"
+_NAME = (r"(?!.*\b" + _CLAUSE + r"\b)(?:named\s+|called\s+|matching\s+)?[\"']?"
+         r"([\w.@'-]+(?:\s+[\w.@'-]+){0,2})[\"']?")
+
+
+def _term(m) -> str:
+    # Quotes and a sentence-ending period around a name search are not part of the name
+    return m.group(1).rstrip(".").strip("'")
+
+
+def _rule(pattern: str):
+    return re.compile(r"^\s*" + pattern + r"\s*[.?!,]*\s*$", re.IGNORECASE)
+
+
+# (intent, pattern, ProvisioningAgent method, argument builder)
+RULES = [
+    ("list_ownerless_groups", _rule(_SHOW + r"\s+(?:the\s+)?(?:first\s+)?" + _NUM + r"\s+(?:ownerless|owner-less|orphaned)\s+groups"),
+     "list_ownerless_groups", lambda m: {"max_results": int(m.group(1))}),
+    ("count_ownerless_groups", _rule(r"(?:count|how\s+many)\s+(?:the\s+)?(?:ownerless|owner-less|orphaned)\s+groups(?:\s+are\s+there)?"),
+     "count_ownerless_groups", lambda m: {}),
+    ("list_groups", _rule(_SHOW + r"\s+(?:the\s+)?(?:first\s+)?" + _NUM + r"\s+groups"),
+     "list_groups", lambda m: {"max_results": int(m.group(1))}),
+    # Only with an explicit number: "all users" is not a capped listing
+    ("list_users", _rule(_SHOW + r"\s+(?:the\s+)?(?:first\s+)?" + _NUM + r"\s+users"),
+     "list_users", lambda m: {"max_results": int(m.group(1))}),
+    ("get_group_owners", _rule(_SHOW + r"\s+(?:the\s+)?owners\s+(?:of|for)\s+(?:the\s+)?group\s+" + _GUID),
+     "get_group_owners", lambda m: {"group_id": m.group(1)}),
+    ("get_group_members", _rule(_SHOW + r"\s+(?:the\s+)?members\s+(?:of|for|in)\s+(?:the\s+)?group\s+" + _GUID),
+     "get_group_members", lambda m: {"group_id": m.group(1)}),
+    ("get_group_details", _rule(_SHOW + r"\s+(?:the\s+)?(?:details\s+(?:of|for)\s+)?(?:the\s+)?group\s+" + _GUID + r"(?:\s+details)?"),
+     "get_group_details", lambda m: {"group_id": m.group(1)}),
+    ("get_user_details", _rule(_SHOW + r"\s+(?:the\s+)?(?:details\s+(?:of|for)\s+)?(?:the\s+)?user\s+(?:" + _UPN + r"|" + _GUID + r")(?:\s+details)?"),
+     "get_user_details", lambda m: {"user_id": m.group(1) or m.group(2)}),
+    ("find_users_in_department", _rule(r"(?:" + _SHOW + r"|find)\s+(?:all\s+)?(?:the\s+)?users\s+in\s+(?:the\s+)?(.+?)\s+department"),
+     "find_users_in_department", lambda m: {"department": m.group(1)}),
+    # "find users in HR" / "from HR" filter by department, which is not a name search
+    ("find_users", _rule(r"(?!.*\bdepartment\b)(?:find|search(?:\s+for)?|look\s+up)\s+users?\s+(?!(?:in|from)\s)" + _NAME),
+     "find_users", lambda m: {"query": _term(m)}),
+    ("find_groups", _rule(r"(?:find|search(?:\s+for)?|look\s+up)\s+groups?\s+" + _NAME),
+     "find_groups", lambda m: {"query": _term(m)}),
+]
+
+
+class IntentRouter:
+    """
+    Regex fast path in front of the orchestrator LLM.
+    - `match(message)` returns (intent, method name, kwargs) only when exactly one rule matches
+    - Per-intent hits and fast-path latency are compared with the running average of LLM turns
+      to report the latency saved
+    """
+    def __init__(self, rules=RULES, enabled: bool = ORCH_FAST_PATH):
+        self.rules = rules
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.misses = 0
+        self.llm_turns = 0
+        self.llm_seconds = 0.0
+        self.intents = {}
+
+    def match(self, message: str) -> Optional[tuple]:
+        if not self.enabled:
+            return None
+        matches = []
+        for intent, pattern, method, build in self.rules:
+            m = pattern.match(message)
+            if m:
+                matches.append((intent, method, build(m)))
+        if len(matches) != 1:
+            with self._lock:
+                self.misses += 1
+            return None
+        return matches[0]
+
+    def record_hit(self, intent: str, seconds: float):
+        with self._lock:
+            entry = self.intents.setdefault(intent, {"hits": 0, "seconds": 0.0, "saved_seconds": 0.0})
+            entry["hits"] += 1
+            entry["seconds"] += seconds
+            if self.llm_turns:
+                entry["saved_seconds"] += max(self.llm_seconds / self.llm_turns - seconds, 0.0)
+
+    def record_llm(self, seconds: float):
+        with self._lock:
+            self.llm_turns += 1
+            self.llm_seconds += seconds
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = sum(e["hits"] for e in self.intents.values())
+            total = hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "hit_rate": round(hits / total, 3) if total else 0.0,
+                "hits": hits,
+                "misses": self.misses,
+                "avg_llm_turn_ms": round(self.llm_seconds / self.llm_turns * 1000, 1) if self.llm_turns else None,
+                "intents": {
+                    intent: {
+                        "hits": e["hits"],
+                        "avg_ms": round(e["seconds"] / e["hits"] * 1000, 1),
+                        "saved_ms_total": round(e["saved_seconds"] * 1000, 1),
+                    }
+                    for intent, e in self.intents.items()
+                },
+            }
@@ -0,0 +1,232 @@
+import re
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Optional
+
+# Prometheus text exposition (format 0.0.4) for agent_service's /metrics, without extra dependencies.
+METRICS_PREFIX = "iamgeni"
+# Seconds; reaches past the UI's 60s (chat) and 120s (orchestrator) request timeouts
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120)
+
+# Stage timings of the HTTP request being served (see `stage`); set by MetricsMiddleware
+request_stages: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("request_stages", default=None)
+# Kernel function currently running, so Graph calls can be attributed to it
+current_function: contextvars.ContextVar[str] = contextvars.ContextVar("current_function", default="none")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = f"{METRICS_PREFIX}_{name}"
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def _header(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self._header() + [f"{self.name}{_labels(self.labelnames, k)} {_number(v)}" for k, v in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """In-flight gauge: up while the block runs."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> list:
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._values.items())
+        lines = self._header()
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+REGISTRY: list = []
+
+http_requests = Counter("http_requests_total", "HTTP requests by route, method and status.",
+                        ("route", "method", "status"))
+http_latency = Histogram("http_request_duration_seconds", "HTTP request latency by route.", ("route", "method"))
+http_in_flight = Gauge("http_requests_in_flight", "HTTP requests being served.")
+stage_latency = Histogram("stage_duration_seconds",
+                          "Time spent per request stage (verify_token, agent_queue_wait, thread_create, "
+                          "agent_run, kernel_function, graph, llm).", ("stage",))
+stage_in_flight = Gauge("stage_in_flight", "Requests currently inside each stage.", ("stage",))
+kernel_function_latency = Histogram("kernel_function_duration_seconds", "Orchestrator plugin function latency.",
+                                    ("function",))
+graph_latency = Histogram("graph_request_duration_seconds", "Microsoft Graph call latency by calling kernel function.",
+                          ("function", "method", "status"))
+
+
+def record_stage(name: str, seconds: float):
+    stage_latency.observe(seconds, stage=name)
+    stages = request_stages.get()
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name: str):
+    """Times a block as request stage `name` (histogram, in-flight gauge and the request's Server-Timing)."""
+    started = time.perf_counter()
+    with stage_in_flight.track(stage=name):
+        try:
+            yield
+        finally:
+            record_stage(name, time.perf_counter() - started)
+
+
+@contextmanager
+def kernel_function(name: str):
+    """Times a plugin function call and attributes the Graph calls made inside it to `name`."""
+    token = current_function.set(name)
+    started = time.perf_counter()
+    try:
+        with stage("kernel_function"):
+            yield
+    finally:
+        kernel_function_latency.observe(time.perf_counter() - started, function=name)
+        current_function.reset(token)
+
+
+def _metric_name(text: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", text).strip("_").lower()
+
+
+def _flatten(prefix: str, value, out: list):
+    if isinstance(value, bool):
+        out.append((prefix, int(value)))
+    elif isinstance(value, (int, float)):
+        out.append((prefix, value))
+    elif isinstance(value, dict):
+        for key, inner in value.items():
+            _flatten(f"{prefix}_{_metric_name(str(key))}", inner, out)
+
+
+def render(stats: Optional[dict] = None) -> str:
+    """
+    All registered metrics, plus the numeric leaves of `stats` (the /stats document) as gauges.
+    - e.g. stats["agent_pool"]["queue_depth"] becomes iamgeni_agent_pool_queue_depth
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    flat = []
+    for component, values in (stats or {}).items():
+        _flatten(f"{METRICS_PREFIX}_{_metric_name(component)}", values, flat)
+    for name, value in flat:
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {_number(value)}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware: per-route request counts, latency histograms and an in-flight gauge.
+    - Routes are labelled by their path template, unmatched paths as "unmatched"
+    - Each response carries a Server-Timing header with the stages recorded so far
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        stages = {}
+        token = request_stages.set(stages)
+        status_code = 500
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                timing = ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in stages.items())
+                if timing:
+                    message = {**message, "headers": list(message.get("headers", [])) +
+                               [(b"server-timing", timing.encode("latin-1"))]}
+            await send(message)
+
+        try:
+            with http_in_flight.track():
+                await self.app(scope, receive, send_with_timing)
+        finally:
+            request_stages.reset(token)
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            http_requests.inc(route=path, method=scope["method"], status=status_code)
+            http_latency.observe(time.perf_counter() - started, route=path, method=scope["method"])
@@ -1,49 +1,742 @@
 import os
-import requests
+import re
+import json
+import time
+import random
+import bisect
+import difflib
+import asyncio
+import threading
+import itertools
+from urllib.parse import quote
+from typing import Optional
+import httpx
 from dotenv import load_dotenv
 from semantic_kernel.functions import kernel_function
 from azure.identity import DefaultAzureCredential
+
+from directory_mirror import DirectoryMirror, GRAPH_MIRROR_PATH
+from single_flight import AsyncSingleFlight
+from metrics import current_function, graph_latency, record_stage
  
 load_dotenv()
+
+GRAPH_TIMEOUT_SECONDS = float(os.getenv("GRAPH_TIMEOUT_SECONDS", "30"))
+GRAPH_CONNECT_TIMEOUT_SECONDS = float(os.getenv("GRAPH_CONNECT_TIMEOUT_SECONDS", "10"))
+GRAPH_MAX_CONNECTIONS = int(os.getenv("GRAPH_MAX_CONNECTIONS", "100"))
+GRAPH_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("GRAPH_MAX_KEEPALIVE_CONNECTIONS", "20"))
+
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx)
+    GRAPH_HTTP2 = os.getenv("GRAPH_HTTP2", "1") != "0"
+except ImportError:
+    GRAPH_HTTP2 = False
+
+
+GRAPH_BATCH_SIZE = 20  # Graph JSON $batch limit
+GRAPH_DEFAULT_PAGE_SIZE = 100  # what /users returns without $top
+GRAPH_BATCH_CONCURRENCY = int(os.getenv("GRAPH_BATCH_CONCURRENCY", "4"))
+GRAPH_MAX_RETRIES = int(os.getenv("GRAPH_MAX_RETRIES", "4"))
+GRAPH_BACKOFF_BASE_SECONDS = float(os.getenv("GRAPH_BACKOFF_BASE_SECONDS", "0.5"))
+GRAPH_BACKOFF_MAX_SECONDS = float(os.getenv("GRAPH_BACKOFF_MAX_SECONDS", "30"))
+GRAPH_MAX_CONCURRENCY = int(os.getenv("GRAPH_MAX_CONCURRENCY", "16"))
+
+# 429/503 mean Graph did not process the request, so any method may be retried;
+# other transient failures are only retried for idempotent methods.
+THROTTLE_STATUSES = {429, 503}
+TRANSIENT_STATUSES = {500, 502, 504}
+IDEMPOTENT_METHODS = {"GET", "PUT", "PATCH", "DELETE"}
+
+
+def retry_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """`Retry-After` seconds when Graph sends one, otherwise full-jitter exponential backoff."""
+    if retry_after:
+        try:
+            return min(float(retry_after), GRAPH_BACKOFF_MAX_SECONDS)
+        except ValueError:
+            pass
+    return random.uniform(0, min(GRAPH_BACKOFF_MAX_SECONDS, GRAPH_BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit for fan-out Graph work (ownerless scans, bulk batches).
+    - Additive increase: roughly +1 slot per window of successful calls
+    - Multiplicative decrease: halves on throttling, at most once per second
+    """
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = GRAPH_MAX_CONCURRENCY):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = max(maximum, initial)
+        self.in_flight = 0
+        self.decreases = 0
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, *exc):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self):
+        self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def on_throttle(self):
+        now = time.monotonic()
+        if now - self._last_decrease >= 1.0:
+            self.limit = max(self.minimum, self.limit / 2)
+            self._last_decrease = now
+            self.decreases += 1
+
+
+class GraphClient:
+    """
+    Shared async HTTP client for Microsoft Graph.
+    - One keep-alive connection pool reused by every ProvisioningAgent call
+    - HTTP/2 when the optional `h2` package is installed
+    - The pool is bound to the running event loop and rebuilt if the loop changes
+    - Throttled and transient failures are retried (see `retry_delay`) and counted in `stats()`
+    """
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.limiter: Optional[AdaptiveLimiter] = None
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.throttle_seconds = 0.0
+        self.transport_errors = 0
+        self._reads = AsyncSingleFlight()
+
+    def _get_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client.is_closed or self._loop is not loop:
+            self._client = httpx.AsyncClient(
+                http2=GRAPH_HTTP2,
+                timeout=httpx.Timeout(GRAPH_TIMEOUT_SECONDS, connect=GRAPH_CONNECT_TIMEOUT_SECONDS),
+                limits=httpx.Limits(
+                    max_connections=GRAPH_MAX_CONNECTIONS,
+                    max_keepalive_connections=GRAPH_MAX_KEEPALIVE_CONNECTIONS,
+                ),
+            )
+            self.limiter = AdaptiveLimiter(GRAPH_BATCH_CONCURRENCY)
+            self._loop = loop
+        return self._client
+
+    def fan_out(self) -> AdaptiveLimiter:
+        """Limiter that fan-out callers hold around each concurrent Graph call."""
+        self._get_client()
+        return self.limiter
+
+    def record_throttle(self, delay: float):
+        self.throttled += 1
+        self.throttle_seconds += delay
+        if self.limiter is not None:
+            self.limiter.on_throttle()
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        method = method.upper()
+        started = time.perf_counter()
+        status_code = "error"
+        try:
+            resp = await self._request(method, url, **kwargs)
+            status_code = resp.status_code
+            return resp
+        finally:
+            # Includes retries and throttling waits: the time the calling kernel function spent on Graph
+            elapsed = time.perf_counter() - started
+            graph_latency.observe(elapsed, function=current_function.get(), method=method, status=status_code)
+            record_stage("graph", elapsed)
+
+    async def _request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        attempt = 0
+        while True:
+            self.requests += 1
+            try:
+                resp = await self._get_client().request(method, url, **kwargs)
+            except httpx.TransportError:
+                self.transport_errors += 1
+                if method not in IDEMPOTENT_METHODS or attempt >= GRAPH_MAX_RETRIES:
+                    raise
+                delay = retry_delay(attempt)
+            else:
+                retryable = resp.status_code in THROTTLE_STATUSES or (
+                    resp.status_code in TRANSIENT_STATUSES and method in IDEMPOTENT_METHODS)
+                if not retryable or attempt >= GRAPH_MAX_RETRIES:
+                    if resp.status_code < 400 and self.limiter is not None:
+                        self.limiter.on_success()
+                    return resp
+                delay = retry_delay(attempt, resp.headers.get("Retry-After"))
+                if resp.status_code in THROTTLE_STATUSES:
+                    self.record_throttle(delay)
+            self.retries += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        # Identical reads already in flight (e.g. several sessions listing groups) share one response
+        headers = kwargs.get("headers") or {}
+        key = (url, tuple(sorted(headers.items())))
+        return await self._reads.do(key, self.request, "GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    async def patch(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("PATCH", url, **kwargs)
+
+    async def delete(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("DELETE", url, **kwargs)
+
+    async def aclose(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "throttle_seconds": round(self.throttle_seconds, 3),
+            "transport_errors": self.transport_errors,
+            "coalesced_reads": self._reads.saved,
+            "concurrency_limit": round(self.limiter.limit, 2) if self.limiter else None,
+            "concurrency_in_flight": self.limiter.in_flight if self.limiter else 0,
+            "concurrency_decreases": self.limiter.decreases if self.limiter else 0,
+        }
+
+
+graph_client = GraphClient()
+
+OWNERLESS_PAGE_SIZE = int(os.getenv("OWNERLESS_PAGE_SIZE", "999"))
+OWNERLESS_COUNT_PREVIEW = int(os.getenv("OWNERLESS_COUNT_PREVIEW", "50"))
+USERS_PAGE_SIZE = 999
+LIST_USERS_DEFAULT_LIMIT = int(os.getenv("LIST_USERS_DEFAULT_LIMIT", "100"))
+
+
+GRAPH_SCOPE = "https://graph.microsoft.com/.default"
+GRAPH_TOKEN_REFRESH_MARGIN_SECONDS = float(os.getenv("GRAPH_TOKEN_REFRESH_MARGIN_SECONDS", "600"))
+GRAPH_TOKEN_RETRY_SECONDS = float(os.getenv("GRAPH_TOKEN_RETRY_SECONDS", "30"))
+
+
+class GraphTokenProvider:
+    """
+    Process-wide Graph access token cache.
+    - The credential is built once, not per agent
+    - A background timer refreshes the token GRAPH_TOKEN_REFRESH_MARGIN_SECONDS before expiry
+    - Callers always get the cached token immediately; only the very first call blocks
+    """
+    def __init__(self):
+        self._credential = None
+        self._token = None
+        self._lock = threading.Lock()
+        self._first_use_lock = threading.Lock()
+        self._refreshing = False
+        self._timer: Optional[threading.Timer] = None
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    @property
+    def credential(self):
+        if self._credential is None:
+            with self._lock:
+                if self._credential is None:
+                    self._credential = DefaultAzureCredential()
+        return self._credential
+
+    def _schedule(self, delay: float):
+        if self._timer is not None:
+            self._timer.cancel()
+        timer = threading.Timer(max(delay, 1.0), self._refresh)
+        timer.daemon = True
+        self._timer = timer
+        timer.start()
+
+    def _refresh(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        try:
+            self._token = self.credential.get_token(GRAPH_SCOPE)
+            self.refreshes += 1
+            self._schedule(self._token.expires_on - time.time() - GRAPH_TOKEN_REFRESH_MARGIN_SECONDS)
+        except Exception as e:
+            self.refresh_failures += 1
+            print(f"⚠️ Graph token refresh failed, retrying in {GRAPH_TOKEN_RETRY_SECONDS}s: {e}")
+            self._schedule(GRAPH_TOKEN_RETRY_SECONDS)
+        finally:
+            self._refreshing = False
+
+    def token(self) -> str:
+        current = self._token
+        if current is None:
+            # First use only: nothing cached yet, so fetch inline.
+            with self._first_use_lock:
+                if self._token is None:
+                    self._refresh()
+            if self._token is None:
+                raise RuntimeError("Unable to acquire a Microsoft Graph access token.")
+            return self._token.token
+        if current.expires_on - time.time() < GRAPH_TOKEN_REFRESH_MARGIN_SECONDS and not self._refreshing:
+            # Timer missed (e.g. suspended host): refresh in the background, keep serving the cached token.
+            threading.Thread(target=self._refresh, daemon=True).start()
+        return current.token
+
+    def stats(self) -> dict:
+        return {
+            "refreshes": self.refreshes,
+            "refresh_failures": self.refresh_failures,
+            "expires_in_seconds": round(self._token.expires_on - time.time()) if self._token else None,
+        }
+
+
+graph_tokens = GraphTokenProvider()
+
+
+DIRECTORY_INDEX_TTL_SECONDS = float(os.getenv("DIRECTORY_INDEX_TTL_SECONDS", "900"))
+# How long a lookup waits for the first index build before answering from Graph directly
+DIRECTORY_INDEX_WAIT_SECONDS = float(os.getenv("DIRECTORY_INDEX_WAIT_SECONDS", "5"))
+FUZZY_CANDIDATES = 200
+FUZZY_MIN_RATIO = 0.6
+
+
+class IndexedObject:
+    """One user or group in the lookup index; `__slots__` keeps it to five references."""
+    __slots__ = ("id", "display_name", "upn", "mail_nickname", "department")
+
+    def __init__(self, id, display_name, upn, mail_nickname, department):
+        self.id = id
+        self.display_name = display_name or ""
+        self.upn = upn or ""
+        self.mail_nickname = mail_nickname or ""
+        self.department = department or ""
+
+    @classmethod
+    def from_graph(cls, item: dict) -> "IndexedObject":
+        return cls(item["id"], item.get("displayName"), item.get("userPrincipalName"),
+                   item.get("mailNickname"), item.get("department"))
+
+
+INDEX_BUILDING_NOTE = "\n(Directory index still building: exact prefix matches only, no typo tolerance.)"
+
+
+def _unchecked_note(unchecked: list) -> str:
+    if not unchecked:
+        return ""
+    return (f"\n⚠️ {len(unchecked)} groups could not be checked for owners (Graph errors after retries), "
+            f"so ownerless groups may be missing from this result.")
+
+
+def _odata_str(value: str) -> str:
+    return value.replace("'", "''")
+
+
+class DirectoryIndex:
+    """
+    Sorted-array lookup index over users or groups.
+    - One sorted key array per field (UPN, every displayName word, mailNickname, department),
+      with a parallel array of objects; a prefix lookup is a binary search plus a short scan
+    - Fuzzy lookup scores the prefix neighbourhood of the query with difflib
+    - Deleted objects are dropped from `by_id` and skipped at query time until the next rebuild
+    """
+    FIELDS = ("upn", "name", "nickname", "department")
+
+    def __init__(self, objects=()):
+        self.by_id = {}
+        self._keys = {f: [] for f in self.FIELDS}
+        self._objects = {f: [] for f in self.FIELDS}
+        pairs = {f: [] for f in self.FIELDS}
+        for obj in objects:
+            self.by_id[obj.id] = obj
+            for field, key in self._index_keys(obj):
+                pairs[field].append((key, obj))
+        for field, items in pairs.items():
+            items.sort(key=lambda pair: pair[0])
+            self._keys[field] = [k for k, _ in items]
+            self._objects[field] = [o for _, o in items]
+        self.built_at = time.time()
+
+    @staticmethod
+    def _index_keys(obj: IndexedObject):
+        if obj.upn:
+            yield "upn", obj.upn.lower()
+        name = obj.display_name.lower()
+        if name:
+            yield "name", name
+            for word in name.split()[1:]:
+                yield "name", word
+        if obj.mail_nickname:
+            yield "nickname", obj.mail_nickname.lower()
+        if obj.department:
+            yield "department", obj.department.lower()
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def add(self, obj: IndexedObject):
+        self.remove(obj.id)
+        self.by_id[obj.id] = obj
+        for field, key in self._index_keys(obj):
+            pos = bisect.bisect_right(self._keys[field], key)
+            self._keys[field].insert(pos, key)
+            self._objects[field].insert(pos, obj)
+
+    def remove(self, object_id: str):
+        self.by_id.pop(object_id, None)
+
+    def _alive(self, obj: IndexedObject) -> bool:
+        return self.by_id.get(obj.id) is obj
+
+    def _scan(self, field: str, prefix: str, exact: bool = False):
+        keys, objects = self._keys[field], self._objects[field]
+        i = bisect.bisect_left(keys, prefix)
+        while i < len(keys) and keys[i].startswith(prefix):
+            if (not exact or keys[i] == prefix) and self._alive(objects[i]):
+                yield keys[i], objects[i]
+            i += 1
+
+    def prefix(self, text: str, limit: int, fields=("upn", "name", "nickname")) -> list:
+        text = text.strip().lower()
+        found = {}
+        for field in fields:
+            for _, obj in self._scan(field, text):
+                found.setdefault(obj.id, obj)
+                if len(found) >= limit:
+                    return list(found.values())
+        return list(found.values())
+
+    def fuzzy(self, text: str, limit: int, fields=("upn", "name", "nickname")) -> list:
+        text = text.strip().lower()
+        scores = {}
+        # Candidates share a short prefix with the query, so typos after the first letters still match.
+        for size in (3, 2, 1):
+            seen = 0
+            for field in fields:
+                for key, obj in itertools.islice(self._scan(field, text[:size]), FUZZY_CANDIDATES):
+                    ratio = difflib.SequenceMatcher(None, text, key[:len(text) + 3]).ratio()
+                    if ratio > scores.get(obj.id, (0, None))[0]:
+                        scores[obj.id] = (ratio, obj)
+                    seen += 1
+            if seen >= limit:
+                break
+        ranked = sorted((s for s in scores.values() if s[0] >= FUZZY_MIN_RATIO), key=lambda s: -s[0])
+        return [obj for _, obj in ranked[:limit]]
+
+    def search(self, text: str, limit: int) -> list:
+        return self.prefix(text, limit) or self.fuzzy(text, limit)
+
+    def in_department(self, department: str, limit: int) -> list:
+        department = department.strip().lower()
+        return [obj for _, obj in itertools.islice(self._scan("department", department, exact=True), limit)]
+
+
+class GraphError(Exception):
+    """Raised by paging helpers when Graph returns a non-success status."""
+
+
+def _split_ids(text: str) -> list:
+    return [part for part in re.split(r"[\s,;]+", text or "") if part]
+
+
+_batch_ids = itertools.count(1)
+
+
+def _batch_op(label: str, method: str, url: str, body: Optional[dict] = None, depends_on: Optional[list] = None) -> dict:
+    op = {"id": str(next(_batch_ids)), "label": label, "method": method, "url": url}
+    if body is not None:
+        op["body"] = body
+        op["headers"] = {"Content-Type": "application/json"}
+    if depends_on:
+        op["dependsOn"] = depends_on
+    return op
+
+
+def _sub_header(response: dict, name: str) -> Optional[str]:
+    for key, value in (response.get("headers") or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+def _touched_id(op: dict) -> str:
+    """Group or user a bulk sub-request writes to, for mirror invalidation."""
+    parts = op["url"].split("/")
+    if len(parts) > 2:
+        return parts[2]
+    return op.get("body", {}).get("userPrincipalName", "")
+
+
+def _batch_ok(response: dict) -> bool:
+    return 200 <= response.get("status", 0) < 300
+
+
+def _summarize_batch(ops: list, results: dict, max_failures: int = 20) -> str:
+    """One compact line of totals plus the first few per-item failures."""
+    if not ops:
+        return "ℹ️ Nothing to do."
+    failures = []
+    for op in ops:
+        r = results.get(op["id"], {"status": 0, "body": "no response"})
+        if not _batch_ok(r):
+            body = r.get("body")
+            message = body.get("error", {}).get("message", "") if isinstance(body, dict) else str(body or "")
+            failures.append(f"- {op['label']}: {r.get('status')} – {message}")
+    ok = len(ops) - len(failures)
+    summary = f"✅ {ok}/{len(ops)} operations succeeded."
+    if failures:
+        summary += f"\n❌ {len(failures)} failed:\n" + "\n".join(failures[:max_failures])
+        if len(failures) > max_failures:
+            summary += f"\n... and {len(failures) - max_failures} more"
+    return summary
+
  
 class ProvisioningAgent:
     def __init__(self):
         print("🔧 Initializing Provisioning Agent...")
-        # Acquire token for Graph
-        self.credential = DefaultAzureCredential()
-        token = self.credential.get_token("https://graph.microsoft.com/.default")
-        self._headers = {
-            "Authorization": f"Bearer {token.token}",
-            "Content-Type": "application/json"
-        }
+        # Acquire token for Graph (cached and refreshed in the background by graph_tokens)
+        self._tokens = graph_tokens
+        self._tokens.token()
+        self.credential = self._tokens.credential
         self.graph_base_url = "https://graph.microsoft.com/v1.0"
+        self._graph = graph_client
+        self._mirror = DirectoryMirror(GRAPH_MIRROR_PATH, self._graph, lambda: self._headers,
+                                       self.graph_base_url) if GRAPH_MIRROR_PATH else None
+        self._indexes = {}
+        self._index_builds = {}
         print("✅ Provisioning Agent ready.\n")
- 
-    @kernel_function(description="List all users in Entra ID.")
-    async def list_users(self) -> str:
-        url = f"{self.graph_base_url}/users"
-        resp = requests.get(url, headers=self._headers)
+
+    @property
+    def _headers(self) -> dict:
+        return {
+            "Authorization": f"Bearer {self._tokens.token()}",
+            "Content-Type": "application/json"
+        }
+
+    def _fresh_mirror(self, *object_ids: str) -> Optional[DirectoryMirror]:
+        """The directory mirror, if enabled, within its staleness bound and not invalidated for these ids."""
+        if self._mirror is None:
+            return None
+        self._mirror.ensure_running()
+        if not self._mirror.is_fresh() or any(self._mirror.is_invalidated(i) for i in object_ids):
+            return None
+        return self._mirror
+
+    # --------------------- Lookup Indexes --------------------- #
+
+    async def _index(self, kind: str) -> Optional[DirectoryIndex]:
+        """
+        In-memory lookup index for `users` or `groups`, or None while the first build is still running.
+        - Builds run as background tasks, with the CPU-heavy parts in a worker thread, so neither the
+          event loop nor the request waits for a full directory crawl
+        - A stale index keeps serving while its replacement is built
+        - The first lookup waits up to DIRECTORY_INDEX_WAIT_SECONDS; a failed first build raises GraphError
+        """
+        index = self._indexes.get(kind)
+        if index is not None and time.time() - index.built_at < DIRECTORY_INDEX_TTL_SECONDS:
+            return index
+        build = self._index_builds.get(kind)
+        if build is None:
+            build = self._index_builds[kind] = asyncio.get_running_loop().create_task(self._build_index(kind))
+            build.add_done_callback(lambda t: t.cancelled() or t.exception())  # failures are logged already
+        if index is not None:
+            return index
+        try:
+            return await asyncio.wait_for(asyncio.shield(build), DIRECTORY_INDEX_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            return None
+
+    async def _build_index(self, kind: str) -> DirectoryIndex:
+        started = time.perf_counter()
+        try:
+            mirror = self._fresh_mirror()
+            if mirror:
+                items = await asyncio.to_thread(
+                    lambda: [IndexedObject.from_graph(dict(row)) for row in mirror.iter_rows(kind)])
+            else:
+                items = await self._fetch_index_items(kind)
+            index = self._indexes[kind] = await asyncio.to_thread(DirectoryIndex, items)
+        except Exception as e:
+            print(f"⚠️ Could not index {kind}: {e}")
+            raise
+        finally:
+            self._index_builds.pop(kind, None)
+        print(f"🔎 Indexed {len(index)} {kind} in {time.perf_counter() - started:.1f}s")
+        return index
+
+    async def _search_directly(self, kind: str, filter_expression: str, max_results: int) -> list:
+        """One page of Graph results for a lookup made before the index is ready."""
+        fields = "id,displayName,userPrincipalName,mailNickname,department" if kind == "users" \
+            else "id,displayName,mailNickname"
+        url = (f"{self.graph_base_url}/{kind}?$select={fields}&$top={min(max_results, 999)}"
+               f"&$count=true&$filter={quote(filter_expression)}")
+        resp = await self._graph.get(url, headers={**self._headers, "ConsistencyLevel": "eventual"})
         if resp.status_code != 200:
-            return f"❌ Error listing users: {resp.status_code} – {resp.text}"
-        users = resp.json().get("value", [])
-        if not users:
+            raise GraphError(f"searching {kind}: {resp.status_code} – {resp.text}")
+        return [IndexedObject.from_graph(item) for item in resp.json().get("value", [])]
+
+    async def _fetch_index_items(self, kind: str) -> list:
+        fields = "id,displayName,userPrincipalName,mailNickname,department" if kind == "users" \
+            else "id,displayName,mailNickname"
+        url = f"{self.graph_base_url}/{kind}?$select={fields}&$top=999"
+        items = []
+        while url:
+            resp = await self._graph.get(url, headers=self._headers)
+            if resp.status_code != 200:
+                raise GraphError(f"listing {kind}: {resp.status_code} – {resp.text}")
+            payload = resp.json()
+            items.extend(IndexedObject.from_graph(item) for item in payload.get("value", []))
+            url = payload.get("@odata.nextLink")
+        return items
+
+    def _indexed(self, index: DirectoryIndex, object_id: str) -> Optional[IndexedObject]:
+        """Index entry by object id or exact UPN."""
+        obj = index.by_id.get(object_id)
+        if obj is None:
+            obj = next((o for o in index.prefix(object_id, 5, fields=("upn",))
+                        if o.upn.lower() == object_id.lower()), None)
+        return obj
+
+    def _index_put(self, kind: str, item: dict):
+        index = self._indexes.get(kind)
+        if index is not None and item.get("id"):
+            index.add(IndexedObject.from_graph(item))
+
+    def _index_update(self, kind: str, object_id: str, field: str, value: str):
+        index = self._indexes.get(kind)
+        obj = self._indexed(index, object_id) if index is not None else None
+        if obj is None:
+            return
+        item = {"id": obj.id, "displayName": obj.display_name, "userPrincipalName": obj.upn,
+                "mailNickname": obj.mail_nickname, "department": obj.department}
+        item[field] = value
+        index.add(IndexedObject.from_graph(item))
+
+    def _index_remove(self, kind: str, object_id: str):
+        index = self._indexes.get(kind)
+        obj = self._indexed(index, object_id) if index is not None else None
+        if obj is not None:
+            index.remove(obj.id)
+
+    def _format_matches(self, matches: list, kind: str) -> str:
+        if not matches:
+            return f"ℹ️ No matching {kind} found."
+        if kind == "users":
+            return "\n".join(f"- {u.display_name} ({u.upn}) [id: {u.id}]"
+                             + (f" – {u.department}" if u.department else "") for u in matches)
+        return "\n".join(f"- {g.display_name} ({g.mail_nickname}) [id: {g.id}]" for g in matches)
+
+    @kernel_function(description="List users in Entra ID, up to max_results. Optionally narrow the list with an "
+                                 "OData filter (e.g. \"department eq 'Sales'\") or a search text matched "
+                                 "against display name and UPN.")
+    async def list_users(self, max_results: int = LIST_USERS_DEFAULT_LIMIT,
+                         filter_expression: str = "", search_text: str = "") -> str:
+        lines = []
+        mirror = None if filter_expression or search_text else self._fresh_mirror()
+        try:
+            if mirror:
+                for u in await mirror.list_users(max_results):
+                    lines.append(f"- {u['displayName']} ({u['userPrincipalName']})")
+            else:
+                async for u in self._iter_users(max_results, filter_expression, search_text):
+                    lines.append(f"- {u.get('displayName')} ({u.get('userPrincipalName')})")
+        except GraphError as e:
+            return f"❌ Error listing users: {e}"
+        if not lines:
             return "ℹ️ No users found."
-        lines = [f"- {u['displayName']} ({u['userPrincipalName']})" for u in users]
+        if mirror:
+            lines.append(mirror.freshness_note())
         return "\n".join(lines)
- 
+
+    async def _iter_users(self, limit: int, filter_expression: str = "", search_text: str = ""):
+        """
+        Yields up to `limit` users, following `@odata.nextLink` one page at a time.
+        - Only displayName and userPrincipalName are selected
+        - No further page is requested once `limit` users have been yielded
+        - `$filter`/`$search` are sent with `ConsistencyLevel: eventual` (required for `$search`
+          and for advanced filters such as endsWith)
+        """
+        if limit <= 0:
+            return
+        url = (f"{self.graph_base_url}/users?$select=displayName,userPrincipalName"
+               f"&$top={min(limit, USERS_PAGE_SIZE)}")
+        extra_headers = {}
+        if filter_expression or search_text:
+            extra_headers["ConsistencyLevel"] = "eventual"
+            url += "&$count=true"
+        if filter_expression:
+            url += f"&$filter={quote(filter_expression)}"
+        if search_text:
+            if '"' not in search_text:
+                search_text = f'"displayName:{search_text}" OR "userPrincipalName:{search_text}"'
+            url += f"&$search={quote(search_text)}"
+
+        yielded = 0
+        while url:
+            resp = await self._graph.get(url, headers={**self._headers, **extra_headers})
+            if resp.status_code != 200:
+                raise GraphError(f"{resp.status_code} – {resp.text}")
+            payload = resp.json()
+            for u in payload.get("value", []):
+                yield u
+                yielded += 1
+                if yielded >= limit:
+                    return
+            url = payload.get("@odata.nextLink")
+
+    @kernel_function(description="Find users by the start of their name, UPN or mail nickname, tolerating typos. "
+                                 "Use this when the user's object ID or exact UPN is not known.")
+    async def find_users(self, query: str, max_results: int = 20) -> str:
+        try:
+            index = await self._index("users")
+            if index is None:
+                q = _odata_str(query)
+                matches = await self._search_directly(
+                    "users", f"startswith(displayName,'{q}') or startswith(userPrincipalName,'{q}') "
+                             f"or startswith(mailNickname,'{q}')", max_results)
+                return self._format_matches(matches, "users") + INDEX_BUILDING_NOTE
+        except GraphError as e:
+            return f"❌ Error {e}"
+        return self._format_matches(index.search(query, max_results), "users")
+
+    @kernel_function(description="List users whose department matches the given name exactly (case-insensitive).")
+    async def find_users_in_department(self, department: str, max_results: int = 50) -> str:
+        try:
+            index = await self._index("users")
+            if index is None:
+                matches = await self._search_directly(
+                    "users", f"department eq '{_odata_str(department)}'", max_results)
+                return self._format_matches(matches, "users") + INDEX_BUILDING_NOTE
+        except GraphError as e:
+            return f"❌ Error {e}"
+        return self._format_matches(index.in_department(department, max_results), "users")
+
     @kernel_function(description="Get details for a specific user by UPN or object ID.")
     async def get_user_details(self, user_id: str) -> str:
-        url = f"{self.graph_base_url}/users/{user_id}"
-        resp = requests.get(url, headers=self._headers)
-        if resp.status_code != 200:
-            return f"❌ Error fetching user '{user_id}': {resp.status_code} – {resp.text}"
-        u = resp.json()
+        mirror = self._fresh_mirror(user_id)
+        u = await mirror.get_user(user_id) if mirror else None
+        if u is None:
+            mirror = None
+            url = f"{self.graph_base_url}/users/{user_id}"
+            resp = await self._graph.get(url, headers=self._headers)
+            if resp.status_code != 200:
+                return f"❌ Error fetching user '{user_id}': {resp.status_code} – {resp.text}"
+            u = resp.json()
         details = [
             f"👤 Display Name: {u.get('displayName')}",
             f"📧 UPN: {u.get('userPrincipalName')}",
             f"🏢 Department: {u.get('department','N/A')}",
             f"🧑‍💼 Title: {u.get('jobTitle','N/A')}"
         ]
+        if mirror:
+            details.append(mirror.freshness_note())
         return "\n".join(details)
  
     @kernel_function(description="Create a new user in Entra ID.")
@@ -63,8 +756,11 @@ class ProvisioningAgent:
                 "password": password
             }
         }
-        resp = requests.post(url, headers=self._headers, json=payload)
+        resp = await self._graph.post(url, headers=self._headers, json=payload)
         if resp.status_code == 201:
+            if self._mirror:
+                await self._mirror.put_user(resp.json())
+            self._index_put("users", resp.json())
             return f"✅ User '{display_name}' created."
         return f"❌ Error creating user: {resp.status_code} – {resp.text}"
  
@@ -75,16 +771,22 @@ class ProvisioningAgent:
                           value: str) -> str:
         url = f"{self.graph_base_url}/users/{user_id}"
         payload = {field: value}
-        resp = requests.patch(url, headers=self._headers, json=payload)
+        resp = await self._graph.patch(url, headers=self._headers, json=payload)
         if resp.status_code == 204:
+            if self._mirror:
+                await self._mirror.update_object("users", user_id, field, value)
+            self._index_update("users", user_id, field, value)
             return f"✅ Updated user '{user_id}': set {field} = {value}"
         return f"❌ Error updating user: {resp.status_code} – {resp.text}"
  
     @kernel_function(description="Delete a user from Entra ID.")
     async def delete_user(self, user_id: str) -> str:
         url = f"{self.graph_base_url}/users/{user_id}"
-        resp = requests.delete(url, headers=self._headers)
+        resp = await self._graph.delete(url, headers=self._headers)
         if resp.status_code == 204:
+            if self._mirror:
+                await self._mirror.remove_object(user_id)
+            self._index_remove("users", user_id)
             return f"🗑️ User '{user_id}' deleted."
         return f"❌ Error deleting user: {resp.status_code} – {resp.text}"
  
@@ -103,6 +805,14 @@ class ProvisioningAgent:
     #     return "\n".join(lines)
     async def list_groups(self, max_results: int) -> str:
 
+        mirror = self._fresh_mirror()
+        if mirror:
+            groups = await mirror.list_groups(max_results)
+            if not groups:
+                return "ℹ️ No groups found."
+            lines = [f"- {g['displayName']} ({g.get('mailNickname') or ''})" for g in groups]
+            return "\n".join(lines + [mirror.freshness_note()])
+
         # Enforce a sane upper bound (Graph allows up to 999 per page)
 
         page_size = min(max_results, 999)
@@ -115,7 +825,7 @@ class ProvisioningAgent:
 
         while url and len(all_groups) < max_results:
 
-            resp = requests.get(url, headers=headers)
+            resp = await self._graph.get(url, headers=headers)
 
             if resp.status_code != 200:
 
@@ -150,19 +860,39 @@ class ProvisioningAgent:
         return "\n".join(lines)
  
  
+    @kernel_function(description="Find groups by the start of their display name or mail nickname, tolerating typos. "
+                                 "Use this when the group's object ID is not known.")
+    async def find_groups(self, query: str, max_results: int = 20) -> str:
+        try:
+            index = await self._index("groups")
+            if index is None:
+                q = _odata_str(query)
+                matches = await self._search_directly(
+                    "groups", f"startswith(displayName,'{q}') or startswith(mailNickname,'{q}')", max_results)
+                return self._format_matches(matches, "groups") + INDEX_BUILDING_NOTE
+        except GraphError as e:
+            return f"❌ Error {e}"
+        return self._format_matches(index.search(query, max_results), "groups")
+
     @kernel_function(description="Get details for a specific group by its object ID.")
     async def get_group_details(self, group_id: str) -> str:
-        url = f"{self.graph_base_url}/groups/{group_id}"
-        resp = requests.get(url, headers=self._headers)
-        if resp.status_code != 200:
-            return f"❌ Error fetching group '{group_id}': {resp.status_code} – {resp.text}"
-        g = resp.json()
+        mirror = self._fresh_mirror(group_id)
+        g = await mirror.get_group(group_id) if mirror else None
+        if g is None:
+            mirror = None
+            url = f"{self.graph_base_url}/groups/{group_id}"
+            resp = await self._graph.get(url, headers=self._headers)
+            if resp.status_code != 200:
+                return f"❌ Error fetching group '{group_id}': {resp.status_code} – {resp.text}"
+            g = resp.json()
         details = [
             f"👥 Name: {g.get('displayName')}",
             f"📧 Nickname: {g.get('mailNickname')}",
             f"🔒 Security Enabled: {g.get('securityEnabled')}",
             f"📅 Created: {g.get('createdDateTime')}"
         ]
+        if mirror:
+            details.append(mirror.freshness_note())
         return "\n".join(details)
  
     @kernel_function(description="Create a new security-enabled group in Entra ID.")
@@ -177,16 +907,22 @@ class ProvisioningAgent:
             "securityEnabled": True,
             "groupTypes": []
         }
-        resp = requests.post(url, headers=self._headers, json=payload)
+        resp = await self._graph.post(url, headers=self._headers, json=payload)
         if resp.status_code == 201:
+            if self._mirror:
+                await self._mirror.put_group(resp.json())
+            self._index_put("groups", resp.json())
             return f"✅ Group '{display_name}' created."
         return f"❌ Error creating group: {resp.status_code} – {resp.text}"
  
     @kernel_function(description="Delete an existing group in Entra ID.")
     async def delete_group(self, group_id: str) -> str:
         url = f"{self.graph_base_url}/groups/{group_id}"
-        resp = requests.delete(url, headers=self._headers)
+        resp = await self._graph.delete(url, headers=self._headers)
         if resp.status_code == 204:
+            if self._mirror:
+                await self._mirror.remove_object(group_id)
+            self._index_remove("groups", group_id)
             return f"🗑️ Group '{group_id}' deleted."
         return f"❌ Error deleting group: {resp.status_code} – {resp.text}"
  
@@ -196,8 +932,10 @@ class ProvisioningAgent:
                                 group_id: str) -> str:
         url = f"{self.graph_base_url}/groups/{group_id}/members/$ref"
         payload = {"@odata.id": f"{self.graph_base_url}/users/{user_id}"}
-        resp = requests.post(url, headers=self._headers, json=payload)
+        resp = await self._graph.post(url, headers=self._headers, json=payload)
         if resp.status_code == 204:
+            if self._mirror:
+                await self._mirror.add_link("members", group_id, user_id)
             return f"✅ User '{user_id}' added to group '{group_id}'."
         return f"❌ Error adding user to group: {resp.status_code} – {resp.text}"
  
@@ -206,8 +944,10 @@ class ProvisioningAgent:
                                      user_id: str,
                                      group_id: str) -> str:
         url = f"{self.graph_base_url}/groups/{group_id}/members/{user_id}/$ref"
-        resp = requests.delete(url, headers=self._headers)
+        resp = await self._graph.delete(url, headers=self._headers)
         if resp.status_code == 204:
+            if self._mirror:
+                await self._mirror.remove_link("members", group_id, user_id)
             return f"🚪 User '{user_id}' removed from group '{group_id}'."
         return f"❌ Error removing user from group: {resp.status_code} – {resp.text}"
  
@@ -217,8 +957,10 @@ class ProvisioningAgent:
                                     group_id: str) -> str:
         url = f"{self.graph_base_url}/groups/{group_id}/owners/$ref"
         payload = {"@odata.id": f"{self.graph_base_url}/users/{owner_id}"}
-        resp = requests.post(url, headers=self._headers, json=payload)
+        resp = await self._graph.post(url, headers=self._headers, json=payload)
         if resp.status_code == 204:
+            if self._mirror:
+                await self._mirror.add_link("owners", group_id, owner_id)
             return f"👑 User '{owner_id}' assigned as owner of group '{group_id}'."
         return f"❌ Error assigning owner: {resp.status_code} – {resp.text}"
     
@@ -227,16 +969,22 @@ class ProvisioningAgent:
         """
         Fetches the list of users who are owners of the given group.
         """
-        url = f"{self.graph_base_url}/groups/{group_id}/owners"
-        resp = requests.get(url, headers=self._headers)
-        if resp.status_code != 200:
-            return f"❌ Error fetching owners for group '{group_id}': {resp.status_code} – {resp.text}"
-
-        owners = resp.json().get("value", [])
+        mirror = self._fresh_mirror(group_id)
+        if mirror and await mirror.get_group(group_id) is not None:
+            owners = await mirror.group_links("owners", group_id)
+        else:
+            mirror = None
+            url = f"{self.graph_base_url}/groups/{group_id}/owners"
+            resp = await self._graph.get(url, headers=self._headers)
+            if resp.status_code != 200:
+                return f"❌ Error fetching owners for group '{group_id}': {resp.status_code} – {resp.text}"
+            owners = resp.json().get("value", [])
         if not owners:
             return f"ℹ️ Group '{group_id}' has no owners."
         lines = [f"- {o.get('displayName')} ({o.get('userPrincipalName', o.get('mailNickname',''))})"
                  for o in owners]
+        if mirror:
+            lines.append(mirror.freshness_note())
         return "\n".join(lines)
     
     @kernel_function(description="Show the members of a specific group by its object ID.")
@@ -244,48 +992,45 @@ class ProvisioningAgent:
         """
         Fetches the list of users who are members of the given group.
         """
-        url = f"{self.graph_base_url}/groups/{group_id}/members"
-        resp = requests.get(url, headers=self._headers)
-        if resp.status_code != 200:
-            return f"❌ Error fetching members for group '{group_id}': {resp.status_code} – {resp.text}"
-
-        members = resp.json().get("value", [])
+        mirror = self._fresh_mirror(group_id)
+        if mirror and await mirror.get_group(group_id) is not None:
+            members = await mirror.group_links("members", group_id)
+        else:
+            mirror = None
+            url = f"{self.graph_base_url}/groups/{group_id}/members"
+            resp = await self._graph.get(url, headers=self._headers)
+            if resp.status_code != 200:
+                return f"❌ Error fetching members for group '{group_id}': {resp.status_code} – {resp.text}"
+            members = resp.json().get("value", [])
         if not members:
             return f"ℹ️ Group '{group_id}' has no members."
         lines = [f"- {m.get('displayName')} ({m.get('userPrincipalName', m.get('mailNickname',''))})"
                  for m in members]
+        if mirror:
+            lines.append(mirror.freshness_note())
         return "\n".join(lines)
 
     @kernel_function(description="Count the total number of groups that have no owners in Entra ID.")
     async def count_ownerless_groups(self) -> str:
         """
-        Lists all groups and counts how many have zero owners.
+        Scans every page of groups and counts how many have zero owners.
         """
-        # 1) Retrieve all groups
-        url = f"{self.graph_base_url}/groups?$select=id,displayName"
-        resp = requests.get(url, headers=self._headers)
-        if resp.status_code != 200:
-            return f"❌ Error listing groups: {resp.status_code} – {resp.text}"
-
-        groups = resp.json().get("value", [])
-        ownerless = []
-
-        # 2) Check owners for each group
-        for g in groups:
-            gid = g["id"]
-            owners_resp = requests.get(f"{self.graph_base_url}/groups/{gid}/owners",
-                                       headers=self._headers)
-            if owners_resp.status_code != 200:
-                # skip groups we can’t query
-                continue
-            if not owners_resp.json().get("value"):
+        ownerless, unchecked = [], []
+        try:
+            async for g in self._iter_ownerless_groups(unchecked):
                 ownerless.append(g["displayName"])
+        except GraphError as e:
+            return f"❌ Error listing groups: {e}"
 
         count = len(ownerless)
+        note = _unchecked_note(unchecked)
         if count == 0:
-            return "ℹ️ Every group has at least one owner."
-        lines = [f"- {name}" for name in ownerless]
-        return f"Total ownerless groups: {count}\n" + "\n".join(lines)
+            return note.lstrip("\n") if unchecked else "ℹ️ Every group has at least one owner."
+        lines = [f"- {name}" for name in ownerless[:OWNERLESS_COUNT_PREVIEW]]
+        if count > OWNERLESS_COUNT_PREVIEW:
+            lines.append(f"... and {count - OWNERLESS_COUNT_PREVIEW} more")
+        total = f"at least {count}" if unchecked else str(count)
+        return f"Total ownerless groups: {total}\n" + "\n".join(lines) + note
 
     @kernel_function(description="Update a field for an existing group in Entra ID.")
     async def update_group(self, group_id: str, field: str, value: str) -> str:
@@ -294,51 +1039,269 @@ class ProvisioningAgent:
         """
         url = f"{self.graph_base_url}/groups/{group_id}"
         payload = {field: value}
-        resp = requests.patch(url, headers=self._headers, json=payload)
+        resp = await self._graph.patch(url, headers=self._headers, json=payload)
         if resp.status_code == 204:
+            if self._mirror:
+                await self._mirror.update_object("groups", group_id, field, value)
+            self._index_update("groups", group_id, field, value)
             return f"✅ Updated group '{group_id}': set {field} = {value}"
         return f"❌ Error updating group '{group_id}': {resp.status_code} – {resp.text}"
     
     @kernel_function(description="List given number ownerless groups in Entra ID.")
     async def list_ownerless_groups(self, max_results: int) -> str:
         """
-        Fetches groups in pages and returns up to `max_results` group display names
+        Scans groups page by page and returns up to `max_results` group display names
         for which no owners are defined.
         """
-        # Fetch a batch of groups at a time (Graph allows up to 999 per page)
-        page_size = min(max_results * 5, 999)
-        url = f"{self.graph_base_url}/groups?$select=id,displayName&$top={page_size}"
-        ownerless = []
-
-        # Iterate pages until we have enough ownerless groups or run out of pages
-        while url and len(ownerless) < max_results:
-            resp = requests.get(url, headers=self._headers)
-            if resp.status_code != 200:
-                return f"❌ Error fetching groups: {resp.status_code} – {resp.text}"
-
-            payload = resp.json()
-            for g in payload.get("value", []):
+        ownerless, unchecked = [], []
+        try:
+            async for g in self._iter_ownerless_groups(unchecked):
+                ownerless.append(g["displayName"])
                 if len(ownerless) >= max_results:
                     break
-
-                # Check owners for this group
-                owners_resp = requests.get(
-                    f"{self.graph_base_url}/groups/{g['id']}/owners",
-                    headers=self._headers
-                )
-                if owners_resp.status_code != 200:
-                    # skip on error
-                    continue
-
-                if not owners_resp.json().get("value"):
-                    ownerless.append(g["displayName"])
-
-            # Follow nextLink if more pages remain
-            url = payload.get("@odata.nextLink")
+        except GraphError as e:
+            return f"❌ Error fetching groups: {e}"
 
         if not ownerless:
-            return "ℹ️ No ownerless groups found."
+            return "ℹ️ No ownerless groups found." + _unchecked_note(unchecked)
 
         # Format as a markdown-style list
         lines = [f"- {name}" for name in ownerless]
-        return "\n".join(lines)
\ No newline at end of file
+        return "\n".join(lines) + _unchecked_note(unchecked)
+
+    # --------------------- Bulk Operations --------------------- #
+
+    @kernel_function(description="Add several users to several groups in Entra ID in one go. "
+                                 "Pass comma-separated user ids and comma-separated group ids.")
+    async def bulk_add_users_to_groups(self, user_ids: str, group_ids: str) -> str:
+        ops = [
+            _batch_op(f"add {u} → {g}", "POST", f"/groups/{g}/members/$ref",
+                      {"@odata.id": f"{self.graph_base_url}/users/{u}"})
+            for g in _split_ids(group_ids) for u in _split_ids(user_ids)
+        ]
+        return await self._run_bulk(ops)
+
+    @kernel_function(description="Remove several users from several groups in Entra ID in one go. "
+                                 "Pass comma-separated user ids and comma-separated group ids. Only call "
+                                 "after the user has confirmed the listed user and group ids.")
+    async def bulk_remove_users_from_groups(self, user_ids: str, group_ids: str) -> str:
+        ops = [
+            _batch_op(f"remove {u} → {g}", "DELETE", f"/groups/{g}/members/{u}/$ref")
+            for g in _split_ids(group_ids) for u in _split_ids(user_ids)
+        ]
+        return await self._run_bulk(ops)
+
+    @kernel_function(description="Assign several owners to several groups in Entra ID in one go. "
+                                 "Pass comma-separated owner ids and comma-separated group ids.")
+    async def bulk_assign_owners_to_groups(self, owner_ids: str, group_ids: str) -> str:
+        ops = [
+            _batch_op(f"owner {o} → {g}", "POST", f"/groups/{g}/owners/$ref",
+                      {"@odata.id": f"{self.graph_base_url}/users/{o}"})
+            for g in _split_ids(group_ids) for o in _split_ids(owner_ids)
+        ]
+        return await self._run_bulk(ops)
+
+    @kernel_function(description="Create several users in Entra ID in one go and optionally add them to groups. "
+                                 "`users` is a JSON array of objects with display_name, user_principal_name "
+                                 "and password; `group_ids` is an optional comma-separated list.")
+    async def bulk_create_users(self, users: str, group_ids: str = "") -> str:
+        try:
+            entries = json.loads(users)
+        except json.JSONDecodeError as e:
+            return f"❌ Error parsing users list: {e}"
+        if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+            return ("❌ Error parsing users list: expected a JSON array of objects with display_name, "
+                    "user_principal_name and password")
+        ops = []
+        for entry in entries:
+            upn = entry.get("user_principal_name", "")
+            create = _batch_op(f"create {upn}", "POST", "/users", {
+                "accountEnabled": True,
+                "displayName": entry.get("display_name", ""),
+                "mailNickname": upn.split("@")[0],
+                "userPrincipalName": upn,
+                "passwordProfile": {
+                    "forceChangePasswordNextSignIn": True,
+                    "password": entry.get("password", "")
+                }
+            })
+            ops.append(create)
+            # Memberships only run once the user exists
+            for g in _split_ids(group_ids):
+                ops.append(_batch_op(f"add {upn} → {g}", "POST", f"/groups/{g}/members/$ref",
+                                     {"@odata.id": f"{self.graph_base_url}/users/{upn}"},
+                                     depends_on=[create["id"]]))
+        return await self._run_bulk(ops)
+
+    @kernel_function(description="Delete several users from Entra ID in one go. Pass comma-separated user ids. "
+                                 "Only call after the user has confirmed the listed user ids.")
+    async def bulk_delete_users(self, user_ids: str) -> str:
+        ops = [_batch_op(f"delete {u}", "DELETE", f"/users/{u}") for u in _split_ids(user_ids)]
+        return await self._run_bulk(ops)
+
+    # --------------------- $batch helpers --------------------- #
+
+    async def _run_bulk(self, ops: list) -> str:
+        results = await self._run_batched(ops)
+        if self._mirror:
+            # Bulk writes touch many objects; let the next delta pass refresh them.
+            self._mirror.invalidate(*filter(None, (_touched_id(op) for op in ops)))
+        for op in ops:
+            r = results.get(op["id"], {})
+            if not _batch_ok(r):
+                continue
+            if op["method"] == "POST" and op["url"] == "/users" and isinstance(r.get("body"), dict):
+                self._index_put("users", r["body"])
+            elif op["method"] == "DELETE" and op["url"].count("/") == 2:
+                self._index_remove("users", op["url"].split("/")[2])
+        return _summarize_batch(ops, results)
+
+    async def _batch(self, requests: list) -> dict:
+        """
+        Sends up to 20 sub-requests through Graph JSON `$batch`.
+        Sub-requests throttled with 429/503, plus dependents that failed with 424 because of them,
+        are re-sent after the largest `Retry-After`, up to GRAPH_MAX_RETRIES times.
+        Returns the sub-responses keyed by request id; if the batch call itself fails,
+        every sub-request is reported with the outer status.
+        """
+        results = {}
+        pending = requests
+        for attempt in range(GRAPH_MAX_RETRIES + 1):
+            resp = await self._graph.post(f"{self.graph_base_url}/$batch",
+                                          headers=self._headers, json={"requests": pending})
+            if resp.status_code != 200:
+                results.update({r["id"]: {"status": resp.status_code, "body": resp.text} for r in pending})
+                break
+            responses = {r["id"]: r for r in resp.json().get("responses", [])}
+            results.update(responses)
+
+            throttled = [rid for rid, r in responses.items() if r.get("status") in THROTTLE_STATUSES]
+            if not throttled or attempt >= GRAPH_MAX_RETRIES:
+                break
+            retry_ids = set(throttled)
+            for r in pending:
+                if responses.get(r["id"], {}).get("status") == 424 and retry_ids & set(r.get("dependsOn", [])):
+                    retry_ids.add(r["id"])
+            pending = [dict(r, dependsOn=[d for d in r.get("dependsOn", []) if d in retry_ids])
+                       for r in pending if r["id"] in retry_ids]
+            for r in pending:
+                if not r["dependsOn"]:
+                    del r["dependsOn"]
+
+            delay = max(retry_delay(attempt, _sub_header(responses[rid], "retry-after")) for rid in throttled)
+            self._graph.record_throttle(delay)
+            self._graph.retries += 1
+            await asyncio.sleep(delay)
+        return results
+
+    async def _run_batched(self, ops: list) -> dict:
+        """
+        Executes `ops` through `$batch`, 20 sub-requests per call, with the number of calls in flight
+        governed by the shared AIMD limiter (starting at GRAPH_BATCH_CONCURRENCY).
+        - Ops are packed in order, so a `dependsOn` chain normally shares a batch and Graph orders it
+        - A batch whose dependencies landed in an earlier batch waits for that batch first
+        - Dependents of a failed op are not sent and are reported as 424
+        Returns the sub-response for every op keyed by op id.
+        """
+        batches = [ops[i:i + GRAPH_BATCH_SIZE] for i in range(0, len(ops), GRAPH_BATCH_SIZE)]
+        batch_of = {op["id"]: index for index, batch in enumerate(batches) for op in batch}
+        done = [asyncio.Event() for _ in batches]
+        results = {}
+        limiter = self._graph.fan_out()
+
+        async def run(index, batch):
+            earlier = {batch_of[d] for op in batch for d in op.get("dependsOn", []) if batch_of[d] != index}
+            for dep_index in sorted(earlier):
+                await done[dep_index].wait()
+            try:
+                to_send = []
+                for op in batch:
+                    failed = [d for d in op.get("dependsOn", []) if d in results and not _batch_ok(results[d])]
+                    if failed:
+                        results[op["id"]] = {"id": op["id"], "status": 424,
+                                             "body": {"error": {"message": f"depends on failed request {failed[0]}"}}}
+                        continue
+                    request = {k: v for k, v in op.items() if k != "label"}
+                    in_batch = [d for d in op.get("dependsOn", []) if batch_of[d] == index]
+                    if in_batch:
+                        request["dependsOn"] = in_batch
+                    else:
+                        request.pop("dependsOn", None)
+                    to_send.append(request)
+                if to_send:
+                    async with limiter:
+                        results.update(await self._batch(to_send))
+            finally:
+                done[index].set()
+
+        await asyncio.gather(*(run(i, b) for i, b in enumerate(batches)))
+        return results
+
+    # --------------------- Ownerless group scan --------------------- #
+
+    async def _owner_flags_by_batch(self, groups: list) -> dict:
+        """
+        Looks up whether each group has an owner using `$batch` (20 groups per request,
+        concurrency governed by the shared AIMD limiter). Groups that cannot be queried are left out
+        (callers report them as unchecked).
+        """
+        limiter = self._graph.fan_out()
+
+        async def run(chunk):
+            async with limiter:
+                return chunk, await self._batch([
+                    {"id": str(i), "method": "GET", "url": f"/groups/{g['id']}/owners?$select=id&$top=1"}
+                    for i, g in enumerate(chunk)
+                ])
+
+        chunks = [groups[i:i + GRAPH_BATCH_SIZE] for i in range(0, len(groups), GRAPH_BATCH_SIZE)]
+        has_owner = {}
+        for chunk, responses in await asyncio.gather(*(run(c) for c in chunks)):
+            for i, g in enumerate(chunk):
+                r = responses.get(str(i))
+                if r and r.get("status") == 200:
+                    has_owner[g["id"]] = bool((r.get("body") or {}).get("value"))
+        return has_owner
+
+    async def _iter_ownerless_groups(self, unchecked: Optional[list] = None):
+        """
+        Yields every ownerless group in the tenant, following `@odata.nextLink` across all pages.
+        Owners come back inline via `$expand=owners($select=id)`, one request per page of groups.
+        If the expansion is rejected, owners are looked up with `$batch` instead; either way
+        there is no per-group round trip. Groups whose owner lookup still failed after retries
+        are appended to `unchecked`.
+        """
+        select_url = f"{self.graph_base_url}/groups?$select=id,displayName&$top={OWNERLESS_PAGE_SIZE}"
+        url = f"{select_url}&$expand=owners($select=id)"
+        use_expand = True
+        first_page = True
+        window = GRAPH_BATCH_SIZE * GRAPH_BATCH_CONCURRENCY
+        while url:
+            resp = await self._graph.get(url, headers=self._headers)
+            if resp.status_code == 400 and use_expand and first_page:
+                use_expand = False
+                url = select_url
+                continue
+            if resp.status_code != 200:
+                raise GraphError(f"{resp.status_code} – {resp.text}")
+            first_page = False
+
+            payload = resp.json()
+            groups = payload.get("value", [])
+            if use_expand:
+                for g in groups:
+                    if not g.get("owners"):
+                        yield g
+            else:
+                # Resolve owners a window at a time so callers with a limit can stop early
+                for start in range(0, len(groups), window):
+                    part = groups[start:start + window]
+                    has_owner = await self._owner_flags_by_batch(part)
+                    for g in part:
+                        flag = has_owner.get(g["id"])
+                        if flag is None and unchecked is not None:
+                            unchecked.append(g)
+                        elif flag is False:
+                            yield g
+
+            url = payload.get("@odata.nextLink")
@@ -0,0 +1,180 @@
+import os
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from semantic_kernel.contents.chat_history import ChatHistory
+
+try:
+    import redis
+except ImportError:  # optional backend
+    redis = None
+
+# Per-thread orchestrator conversations kept on the server, so clients only send the new message.
+ORCH_SESSION_MAX = int(os.getenv("ORCH_SESSION_MAX", "1000"))
+ORCH_SESSION_TTL_SECONDS = float(os.getenv("ORCH_SESSION_TTL_SECONDS", "3600"))
+# Optional second tier that survives restarts and is shared between replicas
+ORCH_SESSION_DIR = os.getenv("ORCH_SESSION_DIR", "")
+ORCH_SESSION_REDIS_URL = os.getenv("ORCH_SESSION_REDIS_URL", "")
+
+
+class FileSessionBackend:
+    """One JSON file per thread (`ChatHistory.serialize()`); expiry is checked against the file mtime."""
+    def __init__(self, directory: str, ttl: float):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, thread_id: str) -> str:
+        safe = "".join(c for c in thread_id if c.isalnum() or c in "-_")
+        return os.path.join(self.directory, f"{safe}.json")
+
+    def load(self, thread_id: str) -> Optional[str]:
+        path = self._path(thread_id)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def save(self, thread_id: str, data: str):
+        path = self._path(thread_id)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def delete(self, thread_id: str):
+        try:
+            os.remove(self._path(thread_id))
+        except FileNotFoundError:
+            pass
+
+
+class RedisSessionBackend:
+    """Any Redis-protocol server; entries expire server-side after the session TTL."""
+    def __init__(self, url: str, ttl: float):
+        if redis is None:
+            raise RuntimeError("ORCH_SESSION_REDIS_URL is set but the 'redis' package is not installed")
+        self._redis = redis.Redis.from_url(url)
+        self.ttl = int(ttl)
+
+    def load(self, thread_id: str) -> Optional[str]:
+        data = self._redis.get(f"orch-session:{thread_id}")
+        return data.decode("utf-8") if data is not None else None
+
+    def save(self, thread_id: str, data: str):
+        self._redis.set(f"orch-session:{thread_id}", data, ex=self.ttl)
+
+    def delete(self, thread_id: str):
+        self._redis.delete(f"orch-session:{thread_id}")
+
+
+class SessionStore:
+    """
+    Bounded map of orchestrator thread id -> ChatHistory.
+    - LRU eviction past `max_sessions`; sessions idle longer than `ttl` are dropped
+    - Optional backend (file or Redis) written after each turn and read on a local miss, off the event loop
+    - `lock(thread_id)` serialises turns on the same thread; its entry lives only while held or awaited
+    """
+    def __init__(self, max_sessions: int = ORCH_SESSION_MAX, ttl: float = ORCH_SESSION_TTL_SECONDS, backend=None):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.backend = backend
+        self._sessions: "OrderedDict[str, tuple]" = OrderedDict()
+        self._locks = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.backend_hits = 0
+        self.evictions = 0
+
+    async def create(self, thread_id: str):
+        await self.put(thread_id, ChatHistory())
+
+    async def get(self, thread_id: str) -> Optional[ChatHistory]:
+        now = time.time()
+        with self._lock:
+            entry = self._sessions.get(thread_id)
+            if entry is not None and now - entry[1] <= self.ttl:
+                self._sessions[thread_id] = (entry[0], now)
+                self._sessions.move_to_end(thread_id)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._sessions[thread_id]
+                self.evictions += 1
+        data = await asyncio.to_thread(self.backend.load, thread_id) if self.backend else None
+        if data is None:
+            self.misses += 1
+            return None
+        self.backend_hits += 1
+        history = ChatHistory.restore_chat_history(data)
+        self._remember(thread_id, history)
+        return history
+
+    async def put(self, thread_id: str, history: ChatHistory):
+        self._remember(thread_id, history)
+        if self.backend:
+            # Serialised on the loop so later turns cannot change the snapshot mid-write
+            await asyncio.to_thread(self.backend.save, thread_id, history.serialize())
+
+    async def delete(self, thread_id: str):
+        with self._lock:
+            self._sessions.pop(thread_id, None)
+        if self.backend:
+            await asyncio.to_thread(self.backend.delete, thread_id)
+
+    @asynccontextmanager
+    async def lock(self, thread_id: str):
+        with self._lock:
+            entry = self._locks.get(thread_id)
+            if entry is None:
+                entry = self._locks[thread_id] = [asyncio.Lock(), 0]
+            entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0 and self._locks.get(thread_id) is entry:
+                    del self._locks[thread_id]
+
+    def _remember(self, thread_id: str, history: ChatHistory):
+        with self._lock:
+            self._sessions[thread_id] = (history, time.time())
+            self._sessions.move_to_end(thread_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = len(self._sessions)
+            locks = len(self._locks)
+        return {
+            "sessions": size,
+            "locks": locks,
+            "max_sessions": self.max_sessions,
+            "hits": self.hits,
+            "misses": self.misses,
+            "backend_hits": self.backend_hits,
+            "evictions": self.evictions,
+            "backend": type(self.backend).__name__ if self.backend else None,
+        }
+
+
+def session_backend():
+    """Backend selected by env: Redis URL first, then a directory, else memory only."""
+    if ORCH_SESSION_REDIS_URL:
+        return RedisSessionBackend(ORCH_SESSION_REDIS_URL, ORCH_SESSION_TTL_SECONDS)
+    if ORCH_SESSION_DIR:
+        return FileSessionBackend(ORCH_SESSION_DIR, ORCH_SESSION_TTL_SECONDS)
+    return None
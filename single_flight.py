@@ -0,0 +1,130 @@
+import asyncio
+import threading
+
+
+# Waiters wake this often to check their own cancel event
+FLIGHT_POLL_SECONDS = 0.25
+
+
+class FlightCancelled(Exception):
+    """The waiter's own cancel event was set while it waited for a leader."""
+
+
+class _Call:
+    __slots__ = ("done", "result")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class SingleFlight:
+    """
+    Collapses concurrent identical blocking calls (worker threads) into one upstream call.
+    - The first caller for a key is the leader and does the work; later callers wait for its result
+    - `join`/`finish` suit leaders that produce the result incrementally (e.g. a stream)
+    - A leader that ends without a result (failed or cancelled) hands over: its waiters re-join and
+      one of them leads the next attempt, instead of all of them running at once
+    - `saved` counts upstream calls avoided
+    """
+    def __init__(self, max_follows: int = 2):
+        self.max_follows = max_follows
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.saved = 0
+
+    def join(self, key, cancel: threading.Event = None) -> tuple:
+        """
+        Returns (result, None) when a leader shared its result, or (None, call) when this caller is
+        the leader and must `finish(key, call, ...)`, or (None, None) after `max_follows` leaders
+        gave no result (the caller then works alone).
+        - Raises FlightCancelled as soon as `cancel` is set while waiting
+        """
+        for _ in range(self.max_follows + 1):
+            with self._lock:
+                call = self._calls.get(key)
+                if call is None:
+                    call = self._calls[key] = _Call()
+                    self.leaders += 1
+                    return None, call
+            while not call.done.wait(FLIGHT_POLL_SECONDS):
+                if cancel is not None and cancel.is_set():
+                    raise FlightCancelled(f"Stopped waiting for {key!r}")
+            if call.result is not None:
+                with self._lock:
+                    self.saved += 1
+                return call.result, None
+        return None, None
+
+    def finish(self, key, call: _Call, result=None):
+        """Ends a leader's call; `result` None means waiters get nothing and re-join."""
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        call.result = result
+        call.done.set()
+
+    def do(self, key, fn, *args, **kwargs):
+        shared, call = self.join(key)
+        if shared is not None:
+            return shared
+        if call is None:
+            return fn(*args, **kwargs)
+        result = None
+        try:
+            result = fn(*args, **kwargs)
+            return result
+        finally:
+            self.finish(key, call, result)
+
+    def stats(self) -> dict:
+        with self._lock:
+            in_flight = len(self._calls)
+        return {"upstream_calls": self.leaders, "saved_calls": self.saved, "in_flight": in_flight}
+
+
+_RETRY = object()  # result handed to waiters when the leader was cancelled
+
+
+class AsyncSingleFlight:
+    """
+    Coroutine counterpart of `SingleFlight`: concurrent awaits of the same key share one call.
+    - If the leader is cancelled (its client went away) the waiters are not: they retry, and the
+      first of them becomes the new leader
+    """
+    def __init__(self):
+        self._calls = {}
+        self.leaders = 0
+        self.saved = 0
+
+    async def do(self, key, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        key = (id(loop), key)
+        future = self._calls.get(key)
+        while future is not None:
+            result = await asyncio.shield(future)
+            if result is not _RETRY:
+                self.saved += 1
+                return result
+            future = self._calls.get(key)
+        future = self._calls[key] = loop.create_future()
+        self.leaders += 1
+        try:
+            result = await fn(*args, **kwargs)
+        except asyncio.CancelledError:
+            future.set_result(_RETRY)
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # marks it retrieved when nobody else was waiting
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+    def stats(self) -> dict:
+        return {"upstream_calls": self.leaders, "saved_calls": self.saved, "in_flight": len(self._calls)}
@@ -0,0 +1,45 @@
+import asyncio
+import threading
+
+from agent_service import AgentRunPool
+
+
+def test_cancelled_queued_call_gives_its_slot_back():
+    pool = AgentRunPool(max_workers=1, max_queue=1)
+    release = threading.Event()
+
+    async def main():
+        running = pool.submit(release.wait)
+        queued = pool.submit(lambda: "never runs")
+        await asyncio.sleep(0.05)
+        queued.cancel()
+        await asyncio.sleep(0.05)
+        during = pool.stats()
+        release.set()
+        await running
+        return during
+
+    during = asyncio.run(main())
+    assert during["in_flight"] == 1 and during["queue_depth"] == 0 and during["cancelled"] == 1
+    assert pool.stats()["in_flight"] == 0
+    pool.shutdown()
+
+
+def test_cancelled_running_call_keeps_its_slot_until_it_ends():
+    pool = AgentRunPool(max_workers=1, max_queue=0)
+    release = threading.Event()
+
+    async def main():
+        running = pool.submit(release.wait)
+        await asyncio.sleep(0.05)
+        running.cancel()
+        await asyncio.sleep(0.05)
+        during = pool.stats()
+        release.set()
+        await asyncio.sleep(0.05)
+        return during
+
+    during = asyncio.run(main())
+    assert during["in_flight"] == 1 and during["running"] == 1
+    assert pool.stats()["in_flight"] == 0 and pool.stats()["cancelled"] == 0
+    pool.shutdown()
@@ -0,0 +1,51 @@
+import pytest
+
+from intent_router import IntentRouter
+
+GUID = "0f8fad5b-d9cb-469f-a165-70867728950e"
+
+
+@pytest.fixture
+def router():
+    return IntentRouter(enabled=True)
+
+
+@pytest.mark.parametrize("message, method, kwargs", [
+    ("list 10 users", "list_users", {"max_results": 10}),
+    ("Show me the first 5 groups.", "list_groups", {"max_results": 5}),
+    ("list 3 ownerless groups", "list_ownerless_groups", {"max_results": 3}),
+    ("how many ownerless groups are there?", "count_ownerless_groups", {}),
+    ("get user john@contoso.com", "get_user_details", {"user_id": "john@contoso.com"}),
+    ("get user john@contoso.com?", "get_user_details", {"user_id": "john@contoso.com"}),
+    ("show details of user jane.doe@contoso.co.uk.", "get_user_details", {"user_id": "jane.doe@contoso.co.uk"}),
+    (f"show owners of group {GUID}", "get_group_owners", {"group_id": GUID}),
+    (f"list members in group {GUID}", "get_group_members", {"group_id": GUID}),
+    ("find users in the Finance department", "find_users_in_department", {"department": "Finance"}),
+    ("find user john smith", "find_users", {"query": "john smith"}),
+    ("find user named 'jo'.", "find_users", {"query": "jo"}),
+    ("search for groups called marketing?", "find_groups", {"query": "marketing"}),
+])
+def test_routes_unambiguous_requests(router, message, method, kwargs):
+    _, routed_method, routed_kwargs = router.match(message)
+    assert (routed_method, routed_kwargs) == (method, kwargs)
+
+
+@pytest.mark.parametrize("message", [
+    "list all users",
+    "list 0 users",
+    "show 0 groups",
+    "find users in HR",
+    "find users from Sales",
+    "find groups with no owners",
+    "find users who have not signed in",
+    "find users that are disabled",
+    "create user john@contoso.com",
+    "delete group " + GUID,
+    "how do I reset my password?",
+])
+def test_leaves_everything_else_to_the_llm(router, message):
+    assert router.match(message) is None
+
+
+def test_disabled_router_never_routes():
+    assert IntentRouter(enabled=False).match("list 10 users") is None
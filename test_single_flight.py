@@ -0,0 +1,109 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+from single_flight import AsyncSingleFlight, FlightCancelled, SingleFlight
+
+
+def test_async_waiters_share_one_call():
+    flight = AsyncSingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "page"
+
+    async def main():
+        return await asyncio.gather(*(flight.do("k", fetch) for _ in range(5)))
+
+    assert asyncio.run(main()) == ["page"] * 5
+    assert len(calls) == 1
+    assert flight.stats() == {"upstream_calls": 1, "saved_calls": 4, "in_flight": 0}
+
+
+def test_cancelled_leader_does_not_cancel_waiters():
+    flight = AsyncSingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "page"
+
+    async def main():
+        leader = asyncio.ensure_future(flight.do("k", fetch))
+        await asyncio.sleep(0)
+        waiters = [asyncio.ensure_future(flight.do("k", fetch)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        return leader, results
+
+    leader, results = asyncio.run(main())
+    assert leader.cancelled()
+    assert results == ["page"] * 3
+    # The cancelled leader's call plus exactly one retry by the new leader
+    assert len(calls) == 2
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_leader_error_reaches_waiters():
+    flight = AsyncSingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        raise ValueError("throttled")
+
+    async def main():
+        return await asyncio.gather(*(flight.do("k", fetch) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(r, ValueError) for r in results)
+
+
+def _in_threads(n, fn):
+    results = [None] * n
+
+    def worker(i):
+        try:
+            results[i] = fn()
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+        time.sleep(0.01)  # the first thread leads
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_failed_leader_hands_over_to_one_waiter():
+    flight = SingleFlight()
+    calls = []
+
+    def answer():
+        calls.append(1)
+        time.sleep(0.1)
+        return None if len(calls) == 1 else "answer"
+
+    assert _in_threads(4, lambda: flight.do("q", answer)) == [None, "answer", "answer", "answer"]
+    # The failed first attempt plus a single retry, not one run per waiter
+    assert len(calls) == 2
+    assert flight.stats()["saved_calls"] == 2
+
+
+def test_waiter_stops_when_its_caller_cancels():
+    flight = SingleFlight()
+    _, call = flight.join("q")
+    cancel = threading.Event()
+    threading.Timer(0.1, cancel.set).start()
+    started = time.perf_counter()
+    with pytest.raises(FlightCancelled):
+        flight.join("q", cancel)
+    assert time.perf_counter() - started < 1
+    flight.finish("q", call, "answer")